@@ -0,0 +1,304 @@
+'''versioned JSON API for slotkeeper, mounted at /api/v1'''
+
+from datetime import datetime
+import hashlib
+from functools import wraps
+import json
+from flask import Blueprint, Response, g, jsonify, make_response, request, session
+import config
+from database import NEXT_RESERVATION_CHANGE, RESERVATION_CONFLICT, RESERVATION_CREATED
+import slotkeeperutil as su
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+db = None
+bus = None
+
+def init_api(app, database, event_bus):
+    '''register api blueprint on app, serving data from database and
+    changes from event_bus'''
+    global db, bus
+    db = database
+    bus = event_bus
+    app.register_blueprint(api)
+
+def error(status, message, **extra):
+    '''json error response'''
+    return jsonify(error=message, **extra), status
+
+def api_login_required(f):
+    '''wrapper to check login and for writes X-CSRF-Token header'''
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.user is None:
+            return error(401, 'Login required.')
+        if request.method != 'GET' and (
+                not session.get('csrf_token') or
+                request.headers.get('X-CSRF-Token') != session['csrf_token']):
+            return error(403, 'Invalid CSRF token.')
+        return f(*args, **kwargs)
+    return decorated_function
+
+def etag_of(full_path, user_id, versions, tables):
+    '''ETag of response to full_path for user while tables have versions,
+    None if the database has no change counters'''
+    if not all(table in versions for table in tables):
+        return None
+    state = [full_path, user_id] + [versions[table] for table in tables]
+    if 'reservations' in tables:
+        # a booking starting or running out changes the answer without a write
+        state.append(versions.get(NEXT_RESERVATION_CHANGE))
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+def conditional(tables, build, missing='Not found.'):
+    '''json response of build() with ETag from the change counters of tables.
+
+    If-None-Match matching the current counters gets 304 without calling
+    build, so an unchanged poll costs one small table_versions read. build
+    returns None for 404 with message missing.
+    '''
+    etag = etag_of(request.full_path, g.user['id'], db.get_table_versions(), tables)
+    if etag:
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+
+    body = build()
+    if body is None:
+        return error(404, missing)
+    response = jsonify(body)
+    if etag:
+        response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def device_json(device):
+    '''search_devices row to json'''
+    return {
+        'id': device['id'],
+        'name': device['name'],
+        'description': device['description'],
+        'created_at': device['created_at'],
+        'creator': device['creator_username'],
+        'reservation': su.device_reservation(device),
+        'upcoming': su.device_upcoming(device)
+    }
+
+def reservation_json(reservation):
+    '''reservation row to json'''
+    return {key: reservation[key] for key in
+            ('id', 'user_id', 'device_id', 'starts_at', 'reserved_until', 'ended_at')}
+
+@api.route('/session')
+@api_login_required
+def get_session():
+    '''logged in user and CSRF token to send back in X-CSRF-Token'''
+    if 'csrf_token' not in session:
+        su.generate_csrf_token(session)
+    return jsonify(user={'id': g.user['id'], 'username': g.user['username']},
+                   csrf_token=session['csrf_token'])
+
+def device_page(user_id, list_args):
+    '''device list page json for user'''
+    after_id, before_id = su.decode_cursor(list_args['cursor'])
+    devices = db.search_devices(list_args['q'], user_id, list_args['only_mine'],
+                                page=list_args['page'],
+                                after_id=after_id,
+                                before_id=before_id,
+                                ranked=config.SEARCH_RANKED,
+                                free_between=su.get_free_between(list_args))
+    next_cursor, prev_cursor = su.page_cursors(devices)
+    return {
+        'items': [device_json(device) for device in devices['items']],
+        'total': devices['total'],
+        'total_exact': devices['total_exact'],
+        'has_next': devices['has_next'],
+        'has_prev': devices['has_prev'],
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor
+    }
+
+@api.route('/devices')
+@api_login_required
+def list_devices():
+    '''device list page, same arguments as the index page'''
+    list_args = su.get_list_args(request.args)
+    return conditional(('devices', 'reservations'), lambda: device_page(g.user['id'], list_args))
+
+@api.route('/devices/<int:device_id>')
+@api_login_required
+def get_device(device_id):
+    '''device with its current reservation'''
+    def build():
+        device = db.get_device_by_id(device_id)
+        if not device:
+            return None
+        reservation = db.get_active_reservation_for_device(device_id)
+        return {
+            'id': device['id'],
+            'name': device['name'],
+            'description': device['description'],
+            'created_at': device['created_at'],
+            'creator': device['creator_username'],
+            'reservation': reservation and dict(reservation_json(reservation),
+                                                username=reservation['username'])
+        }
+
+    return conditional(('devices', 'reservations'), build, missing='Device not found.')
+
+@api.route('/reservations')
+@api_login_required
+def list_reservations():
+    '''active and upcoming reservations of logged in user'''
+    def build():
+        return {'items': [
+            {'id': row['id'], 'device_name': row['name'],
+             'reserved_until': row['reserved_until'], 'upcoming_start': row['upcoming_start']}
+            for row in db.get_active_reservations_by_user(g.user['id'])]}
+
+    return conditional(('devices', 'reservations'), build)
+
+@api.route('/devices/<int:device_id>/reservations', methods=['POST'])
+@api_login_required
+def reserve(device_id):
+    '''reserve device, json body has ISO times reserved_until and optional starts_at'''
+    body = request.get_json(silent=True) or {}
+    reserved_until = body.get('reserved_until')
+    starts_at = body.get('starts_at')
+    try:
+        until = datetime.fromisoformat(reserved_until)
+        if starts_at:
+            datetime.fromisoformat(starts_at)
+    except (TypeError, ValueError):
+        return error(400, 'reserved_until and starts_at must be ISO 8601 times.')
+    if until.timestamp() <= datetime.now().timestamp():
+        return error(400, 'Reservation must end in the future.')
+    if not db.get_device_by_id(device_id):
+        return error(404, 'Device not found.')
+
+    status, conflict = db.create_reservation(g.user['id'], device_id, reserved_until,
+                                             starts_at=starts_at)
+    if status == RESERVATION_CONFLICT:
+        return error(409, 'Device is already reserved.',
+                     conflict=dict(reservation_json(conflict), username=conflict['username']))
+    if status != RESERVATION_CREATED:
+        return error(400, 'Reservation failed.')
+    return jsonify(status='created'), 201
+
+@api.route('/reservations/<int:reservation_id>', methods=['DELETE'])
+@api_login_required
+def release(reservation_id):
+    '''release own reservation'''
+    reservation = db.get_reservation_by_id(reservation_id)
+    if not reservation:
+        return error(404, 'Reservation not found.')
+    if reservation['user_id'] != g.user['id']:
+        return error(403, 'Not your reservation.')
+    db.cancel_reservation(reservation_id)
+    return '', 204
+
+@api.route('/devices/<int:device_id>/comments')
+@api_login_required
+def list_comments(device_id):
+    '''comment page of device, newest first, ?before=cursor for older ones'''
+    def build():
+        comments = db.get_comment_page(device_id,
+                                       before=su.decode_comment_cursor(request.args.get('before')),
+                                       limit=config.COMMENTS_PER_PAGE)
+        return {
+            'items': comments['items'],
+            'next_cursor': (su.encode_comment_cursor(comments['next_before'])
+                            if comments['has_more'] else None)
+        }
+
+    return conditional(('comments',), build)
+
+@api.route('/devices/<int:device_id>/comments', methods=['POST'])
+@api_login_required
+def add_comment(device_id):
+    '''add comment to device, json body has the comment as content'''
+    content = ((request.get_json(silent=True) or {}).get('content') or '').strip()
+    if not content:
+        return error(400, 'Comment cannot be empty.')
+    if len(content) > 1024:
+        return error(400, 'Comment too long (max 1024 chars).')
+    if not db.get_device_by_id(device_id):
+        return error(404, 'Device not found.')
+    if not db.add_comment(device_id, g.user['id'], content):
+        return error(400, 'Failed to add comment.')
+    return jsonify(status='created'), 201
+
+@api.route('/comments/<int:comment_id>', methods=['DELETE'])
+@api_login_required
+def delete_comment(comment_id):
+    '''delete own comment'''
+    if not db.get_comment_by_id(comment_id):
+        return error(404, 'Comment not found.')
+    if not db.delete_comment(comment_id, g.user['id']):
+        return error(403, 'Not your comment.')
+    return '', 204
+
+@api.route('/debug/queries')
+@api_login_required
+def query_totals():
+    '''SQL statement totals since start, ?limit= statements with most time,
+    only with config.QUERY_STATS_DEBUG'''
+    if db.query_stats is None or not config.QUERY_STATS_DEBUG:
+        return error(404, 'Query statistics are disabled.')
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify(dict(db.query_stats.snapshot(limit), pool=db.pool_stats()))
+
+def event_id_arg(value):
+    '''last seen event id from header or query, None if missing or broken'''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def poll_timeout_arg(value):
+    '''long-poll wait in seconds from query, capped to EVENT_POLL_TIMEOUT'''
+    try:
+        timeout = min(float(value), config.EVENT_POLL_TIMEOUT)
+    except (TypeError, ValueError):
+        timeout = config.EVENT_POLL_TIMEOUT
+    return max(timeout, 0)
+
+def sse_event(event):
+    '''event in Server-Sent Events format'''
+    event_id, kind = event['id'], event['type']
+    return f'id: {event_id}\nevent: {kind}\ndata: {json.dumps(event)}\n\n'
+
+@api.route('/events')
+@api_login_required
+def event_stream():
+    '''Server-Sent Events stream of changes, resumes after Last-Event-ID'''
+    after_id = event_id_arg(request.headers.get('Last-Event-ID') or request.args.get('after'))
+    if after_id is None:
+        after_id = bus.last_id()
+
+    def stream(last_id):
+        yield 'retry: 3000\n\n'
+        while True:
+            events = bus.wait(last_id, config.EVENT_KEEPALIVE)
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            for event in events:
+                yield sse_event(event)
+            last_id = events[-1]['id']
+
+    return Response(stream(after_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@api.route('/events/poll')
+@api_login_required
+def poll_events():
+    '''long-poll for changes after ?after=id, waits up to ?timeout= seconds.
+    Without after returns at once with last_id to start polling from'''
+    after_id = event_id_arg(request.args.get('after'))
+    if after_id is None:
+        return jsonify(events=[], last_id=bus.last_id())
+
+    events = bus.wait(after_id, poll_timeout_arg(request.args.get('timeout')))
+    return jsonify(events=events, last_id=events[-1]['id'] if events else after_id)
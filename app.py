@@ -5,24 +5,117 @@ from datetime import datetime
 from functools import wraps
 import math
 import time
-from flask import Flask, render_template, request, redirect, session, url_for
+from flask import Flask, Response, abort, g, render_template, request, redirect, session, url_for
+from markupsafe import Markup, escape
 from werkzeug.security import generate_password_hash, check_password_hash
 import config
-from database import Database
+from api import init_api
+from database import Database, RESERVATION_CONFLICT, RESERVATION_CREATED
+from events import EventBus
+from metrics import Metrics, cache_families, pool_families, query_families
+from querystats import QueryStats
+from slotkeepercache import FragmentCache, TTLCache
 import slotkeeperutil as su
+import sweeper
 
 app = Flask(__name__)
-ITEMS_PER_PAGE = 10
-DATABASE = 'database.db'
+ITEMS_PER_PAGE = config.ITEMS_PER_PAGE
+DATABASE = config.DATABASE
 app.secret_key = config.SECRET_KEY  # Used to sign session cookies
+query_stats = (QueryStats(config.SLOW_QUERY_SECONDS, config.SLOW_QUERY_EXPLAIN_INTERVAL)
+               if config.QUERY_STATS else None)
 '''Instantiate the database class'''
-db = Database(DATABASE, ITEMS_PER_PAGE)
+db = Database(DATABASE, ITEMS_PER_PAGE,
+              pool_size=config.DB_POOL_SIZE,
+              pool_timeout=config.DB_POOL_TIMEOUT,
+              pragmas=config.DB_PRAGMAS,
+              count_ttl=config.COUNT_CACHE_TTL,
+              count_limit=config.COUNT_LIMIT,
+              user_cache_size=config.USER_CACHE_SIZE,
+              write_retries=config.DB_WRITE_RETRIES,
+              write_backoff=config.DB_WRITE_BACKOFF,
+              query_stats=query_stats)
+# changes committed through db, followed by api event stream and long-poll
+event_bus = EventBus(config.EVENT_BUFFER_SIZE)
+db.add_listener(event_bus.publish)
+init_api(app, db, event_bus)
+
+# rendered device card heads and user page charts
+fragment_cache = FragmentCache(config.FRAGMENT_CACHE_CHARS)
+
+# device list pages per user, redrawn from here under reserve and device modals
+list_cache = TTLCache(config.LIST_CACHE_TTL, config.LIST_CACHE_SIZE)
+
+# route latency and status counts, pool, cache and SQL totals read on scrape
+metrics = Metrics()
+metrics.add_collector(lambda: pool_families(db.pool_stats()))
+metrics.add_collector(lambda: cache_families({
+    'device_count': db.count_cache_stats(),
+    'user': db.user_cache_stats(),
+    'device_list': list_cache.stats(),
+    'fragment': fragment_cache.stats()
+}))
+if query_stats:
+    metrics.add_collector(lambda: query_families(query_stats.totals()))
+
+@app.before_request
+def start_request_timer():
+    '''start of request for route latency metrics'''
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    '''count request into route metrics'''
+    queries = g.get('queries')
+    metrics.observe(request.endpoint or '(unmatched)', request.method, response.status_code,
+                    time.perf_counter() - g.get('request_start', time.perf_counter()),
+                    queries.count if queries else 0,
+                    queries.seconds if queries else 0.0)
+    return response
+
+@app.before_request
+def count_queries():
+    '''count SQL statements of this request into g.queries'''
+    g.queries = query_stats.begin_request() if query_stats else None
+
+@app.after_request
+def add_query_headers(response):
+    '''statement count and time of this request as response headers'''
+    queries = g.get('queries')
+    if queries is not None and config.QUERY_STATS_DEBUG:
+        response.headers['X-SQL-Queries'] = str(queries.count)
+        response.headers['Server-Timing'] = f'db;dur={queries.seconds * 1000:.2f}'
+    return response
+
+@app.teardown_request
+def stop_counting_queries(_error):
+    '''statements after the response, e.g. of event streams, are not counted'''
+    if query_stats:
+        query_stats.end_request()
+
+@app.before_request
+def load_logged_in_user():
+    '''resolve logged in user once per request into g.user'''
+    g.user = None
+    user_id = session.get('user_id')
+
+    # sessions from before user_id was stored carry only the username
+    if user_id is None and 'username' in session:
+        user = db.get_user_by_username(session['username'])
+        if user:
+            user_id = session['user_id'] = user['id']
+
+    if user_id is not None:
+        g.user = db.get_user_by_id(user_id)
+        if g.user is None:
+            session.pop('username', None)
+            session.pop('user_id', None)
 
 def login_required_with_csrf(f):
     '''wrapper to check login and for POST csrf status'''
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'username' not in session:
+        if g.user is None:
             return render_template('login.html',
                                    error='Session error.',
                                    csrf_token=session['csrf_token'])
@@ -33,38 +126,78 @@ def login_required_with_csrf(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def device_list_context(user_id, list_args, cached=False):
+    '''search device list page and build its template arguments.
+    With cached the page user last saw is reused if it is fresh enough'''
+    cache_key = (user_id, tuple(sorted(list_args.items())))
+    if cached:
+        context = list_cache.get(cache_key)
+        if context is not None:
+            return context
+
+    after_id, before_id = su.decode_cursor(list_args['cursor'])
+    devices = db.search_devices(list_args['q'], user_id, list_args['only_mine'],
+                                page=list_args['page'],
+                                after_id=after_id,
+                                before_id=before_id,
+                                ranked=config.SEARCH_RANKED,
+                                free_between=su.get_free_between(list_args))
+    next_cursor, prev_cursor = su.page_cursors(devices)
+
+    context = {
+        'devices': su.fill_in_device_list(user_id, devices['items'], device_card_parts),
+        'query': list_args['q'],
+        'only_mine': list_args['only_mine'],
+        'cursor': list_args['cursor'],
+        'free_from': list_args['free_from'],
+        'free_until': list_args['free_until'],
+        'list_args': su.url_list_args(list_args),
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+        'has_next': devices['has_next'],
+        'has_prev': devices['has_prev'],
+        'current_page': list_args['page'],
+        'total_pages': math.ceil(devices['total'] / ITEMS_PER_PAGE),
+        'total_exact': devices['total_exact']
+    }
+    list_cache.set(cache_key, context)
+    return context
+
+def comment_page_context(device_id, before_cursor):
+    '''comment page of device and its template arguments'''
+    comments = db.get_comment_page(device_id,
+                                   before=su.decode_comment_cursor(before_cursor),
+                                   limit=config.COMMENTS_PER_PAGE)
+    return {
+        'comments': comments['items'],
+        'next_comments_cursor': (su.encode_comment_cursor(comments['next_before'])
+                                 if comments['has_more'] else None)
+    }
+
 @app.route('/')
 def index():
     '''Base index.html rendering'''
-    if 'username' in session:
-        user = db.get_user_by_username(session['username'])
-        user_id = user['id'] if user else None
-
-        query = request.args.get('q', '')
-        only_mine = request.args.get('only_mine') == '1'
+    if g.user:
+        user_id = g.user['id']
 
-        try:
-            page = int(request.args.get('page', 1))
-        except ValueError:
-            page = 1
-        page = max(page, 1)
-
-        devices = db.search_devices(query, user_id, only_mine, page=page)
-        device_data = su.fill_in_device_list(session, db, devices['items'])
+        list_context = device_list_context(user_id, su.get_list_args(request.args))
 
         csrf_token = su.generate_csrf_token(session)
         return render_template(
             'index.html',
             username=session['username'],
-            devices=device_data,
-            query=query,
-            only_mine=only_mine,
             csrf_token=csrf_token,
-            current_page=page,
-            total_pages=math.ceil(devices['total'] / ITEMS_PER_PAGE))
+            **list_context)
 
     return render_template('index.html', username=None)
 
+@app.route('/metrics')
+def metrics_page():
+    '''Prometheus metrics in text exposition format'''
+    if not config.METRICS:
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     '''Handle registration'''
@@ -114,6 +247,7 @@ def login():
 
         if user and check_password_hash(user['password_hash'], password):
             session['username'] = username
+            session['user_id'] = user['id']
             return redirect(url_for('index'))
 
         return render_template('login.html',
@@ -127,6 +261,7 @@ def login():
 def logout():
     '''Log out..'''
     session.pop('username', None)
+    session.pop('user_id', None)
     return redirect(url_for('index'))
 
 @app.route('/add_device', methods=['GET', 'POST'])
@@ -138,7 +273,6 @@ def add_device():
     if request.method == 'POST':
         name = request.form['name'].strip()
         description = request.form['description']
-        user = db.get_user_by_username(session['username'])
 
         if not name:
             error = 'Device name is required.'
@@ -150,7 +284,7 @@ def add_device():
             error = 'Description too long (max 4096 characters).'
 
         if not error:
-            db.add_device(name, description, user['id'])
+            db.add_device(name, description, g.user['id'])
             return redirect(url_for('index'))
 
     csrf_token = su.generate_csrf_token(session)
@@ -183,22 +317,23 @@ def delete_device(device_id):
 @app.route('/reserve/<int:device_id>', methods=['GET', 'POST'])
 def reserve(device_id):
     '''Handle reserve device from UI'''
-    user_id = db.get_user_by_username(session['username'])['id']
+    user_id = g.user['id']
 
     if request.method == 'POST':
         reserved_until = request.form['reserved_until']
-        original_page = request.form.get('original_page', 1, type=int)
-        original_query = request.form.get('original_query', '')
-        original_only_mine_str = request.form.get('original_only_mine', '')
-        original_only_mine_bool = original_only_mine_str == '1'
+        reserved_from = request.form.get('reserved_from') or None
 
         try:
             reserved_int = int(datetime.strptime(reserved_until, '%Y-%m-%dT%H:%M').timestamp())
-            if reserved_int <= time.time():
+            from_int = time.time()
+            if reserved_from:
+                from_int = max(datetime.strptime(reserved_from, '%Y-%m-%dT%H:%M').timestamp(),
+                               from_int)
+            if reserved_int <= from_int:
                 return render_template(
                     'index.html',
                     username=session['username'],
-                    modal_error='Reservation must be in the future.',
+                    modal_error='Reservation must end in the future and after it starts.',
                     csrf_token=session['csrf_token']
                 )
         except ValueError:
@@ -209,39 +344,38 @@ def reserve(device_id):
                 csrf_token=session['csrf_token']
             )
 
-        db.create_reservation(user_id, device_id, reserved_until)
-        return redirect(url_for('index',
-                                page=original_page,
-                                q=original_query,
-                                only_mine=('1' if original_only_mine_bool else None)))
+        status, conflict = db.create_reservation(user_id, device_id, reserved_until,
+                                                 starts_at=reserved_from)
+        if status != RESERVATION_CREATED:
+            if status == RESERVATION_CONFLICT:
+                holder = conflict['username']
+                since = datetimeformat(conflict['starts_at'])
+                until = datetimeformat(conflict['reserved_until'])
+                error = f'Device is already reserved by {holder} from {since} until {until}.'
+            else:
+                error = 'Reservation failed.'
+            return render_template(
+                'index.html',
+                username=session['username'],
+                modal_error=error,
+                csrf_token=session['csrf_token']
+            )
+        return redirect(url_for('index', **su.get_original_list_args(request.form)))
 
     device = db.get_device_by_id(device_id)
     if device:
-        query = request.args.get('q', '')
-        only_mine = request.args.get('only_mine') == '1'
-
-        try:
-            page = int(request.args.get('page', 1))
-        except ValueError:
-            page = 1
-        page = max(page, 1)
-
-        devices = db.search_devices(query, user_id, only_mine, page=page)
-        device_data = su.fill_in_device_list(session, db, devices['items'])
+        list_context = device_list_context(user_id, su.get_list_args(request.args),
+                                           cached=True)
 
         csrf_token = su.generate_csrf_token(session)
         return render_template(
             'index.html',
             username=session['username'],
-            devices=device_data,
-            query=query,
-            only_mine=only_mine,
             show_reservation_modal=True,
             modal_device=device,
             modal_error=None,
             csrf_token=csrf_token,
-            current_page=page,
-            total_pages=math.ceil(devices['total'] / ITEMS_PER_PAGE))
+            **list_context)
     return render_template(
             'index.html',
             username=session['username'],
@@ -254,15 +388,9 @@ def reserve(device_id):
 def cancel_reservation(reservation_id):
     '''Handle releasing reservation from UI'''
     db.cancel_reservation(reservation_id)
-    original_page = request.form.get('original_page', 1, type=int)
-    original_query = request.form.get('original_query', '')
-    original_only_mine_str = request.form.get('original_only_mine', '')
-    original_only_mine_bool = original_only_mine_str == '1'
-
-    return redirect(url_for('index',
-                            page=original_page,
-                            q=original_query,
-                            only_mine=('1' if original_only_mine_bool else None)))
+    if request.form.get('return_to') == 'user':
+        return redirect(url_for('user_page'))
+    return redirect(url_for('index', **su.get_original_list_args(request.form)))
 
 @app.template_filter('datetimeformat')
 def datetimeformat(value):
@@ -273,10 +401,7 @@ def datetimeformat(value):
 @login_required_with_csrf
 def view_device(device_id):
     '''Detail view of device'''
-    user = db.get_user_by_username(session['username'])
-    if not user:
-        return redirect(url_for('login'))
-    user_id = user['id']
+    user_id = g.user['id']
 
     modal_device = db.get_device_by_id(device_id)
     if not modal_device:
@@ -287,19 +412,9 @@ def view_device(device_id):
             csrf_token=session['csrf_token']
         )
 
-    comments = db.get_comments_for_device(device_id)
+    comments = comment_page_context(device_id, request.args.get('comments_before'))
 
-    query = request.args.get('q', '')
-    only_mine = request.args.get('only_mine') == '1'
-
-    try:
-        page = int(request.args.get('page', 1))
-    except ValueError:
-        page = 1
-    page = max(page, 1)
-
-    devices = db.search_devices(query, user_id, only_mine, page=page)
-    device_data = su.fill_in_device_list(session, db, devices['items'])
+    list_context = device_list_context(user_id, su.get_list_args(request.args), cached=True)
 
     error_message = request.args.get('error')
     csrf_token = su.generate_csrf_token(session)
@@ -307,36 +422,36 @@ def view_device(device_id):
     return render_template(
         'index.html',
         username=session['username'],
-        devices=device_data,
-        query=query,
-        only_mine=only_mine,
         modal_device=modal_device,
-        comments=comments,
-        current_user_id=user['id'],
+        current_user_id=user_id,
         show_device_detail_modal=True,
         modal_error=error_message,
         csrf_token=csrf_token,
-        current_page=page,
-        total_pages=math.ceil(devices['total'] / ITEMS_PER_PAGE))
+        **comments,
+        **list_context)
 
-@app.route('/user')
+@app.route('/device/<int:device_id>/comments')
 @login_required_with_csrf
-def user_page():
-    '''Show user page on UI'''
-    username = session['username']
-    reservations = db.get_active_reservations_by_user(username)
-    devices = db.get_devices_created_by_user(username)
-    user = db.get_user_by_username(username)
-
-    if not user:
-        session.pop('username', None)
-        session.pop('user_id', None)
-        return redirect(url_for('login', error='User data not found, please log in again.'))
-
-    user_id = user['id']
+def device_comments(device_id):
+    '''Older comments of device as html fragment for load more'''
+    return render_template(
+        '_comments.html',
+        device_id=device_id,
+        current_user_id=g.user['id'],
+        csrf_token=session['csrf_token'],  # same token as the page it is loaded into
+        list_args=su.url_list_args(su.get_list_args(request.args)),
+        **comment_page_context(device_id, request.args.get('before')))
+
+def user_charts(user_id, version):
+    '''rendered reservation pie charts of user, cached by version from
+    get_user_dashboard(), the rollup is only read to render them again'''
+    key = ('charts', user_id)
+    if version is not None:
+        charts = fragment_cache.get(key, version)
+        if charts is not None:
+            return charts
 
     device_res = db.get_user_device_reservations(user_id)
-
     pie_data_counts, gradient_counts, has_pie_counts = su.generate_pie_chart_segments(
         device_res[0],
         label_key='device_name',
@@ -357,33 +472,56 @@ def user_page():
         label_key='device_name',
         preform_key='formatted_duration')
 
+    charts = Markup(render_template(
+        '_user_charts.html',
+        pie_chart_data_counts=pie_data_counts,
+        conic_gradient_style_counts=gradient_counts,
+        has_reservations_for_pie_counts=has_pie_counts,
+        pie_chart_data_durations=pie_data_durations,
+        conic_gradient_style_durations=gradient_durations,
+        has_reservations_for_pie_durations=has_pie_durations))
+    if version is not None:
+        fragment_cache.set(key, version, charts)
+    return charts
+
+def device_card_parts(device):
+    '''rendered (head, preview) of device card, cached per device version'''
+    key = ('device', device['id'])
+    parts = fragment_cache.get(key, device['version'])
+    if parts is None:
+        parts = (Markup(render_template('_device_head.html', device=device)),
+                 escape(su.description_preview(device['description'])))
+        fragment_cache.set(key, device['version'], parts)
+    return parts
+
+def drop_fragments(kind, **data):
+    '''database change listener, forget fragments of changed device'''
+    if kind in ('device_updated', 'device_deleted'):
+        fragment_cache.pop(('device', data['device_id']))
+
+db.add_listener(drop_fragments)
+
+@app.route('/user')
+@login_required_with_csrf
+def user_page():
+    '''Show user page on UI'''
+    username = g.user['username']
+    dashboard = db.get_user_dashboard(g.user['id'])
+
     return render_template('user_page.html',
                            username=username,
-                           reservations=reservations,
-                           devices=devices,
-                           last_reservations=db.get_last_reservations_by_user(username),
-                           pie_chart_data_counts=pie_data_counts,
-                           conic_gradient_style_counts=gradient_counts,
-                           has_reservations_for_pie_counts=has_pie_counts,
-                           pie_chart_data_durations=pie_data_durations,
-                           conic_gradient_style_durations=gradient_durations,
-                           has_reservations_for_pie_durations=has_pie_durations)
+                           reservations=dashboard['reservations'],
+                           devices=dashboard['devices'],
+                           last_reservations=dashboard['last_reservations'],
+                           csrf_token=session['csrf_token'],
+                           charts=user_charts(g.user['id'], dashboard['charts_version']))
 
 @app.route('/device/<int:device_id>/add_comment', methods=['POST'])
 @login_required_with_csrf
 def add_comment_to_device(device_id):
     '''Add comment to device, on device page'''
-    user = db.get_user_by_username(session['username'])
     error = None
 
-    if not user:
-        return 'User not found', 403
-
-    original_page = request.form.get('original_page', 1, type=int)
-    original_query = request.form.get('original_query', '')
-    original_only_mine_str = request.form.get('original_only_mine', '')
-    original_only_mine_bool = original_only_mine_str == '1'
-
     content = request.form.get('comment_content')
     if not content or len(content.strip()) == 0:
         error = 'Comment cannot be empty.'
@@ -392,31 +530,25 @@ def add_comment_to_device(device_id):
         error = 'Comment too long (max 1024 chars).'
 
     if not error:
-        if not db.add_comment(device_id, user['id'], content.strip()):
+        if not db.add_comment(device_id, g.user['id'], content.strip()):
             error = 'Failed to add comment.'
 
     return redirect(url_for('view_device',
                             device_id=device_id,
                             error=error,
-                            page=original_page,
-                            q=original_query,
-                            only_mine=('1' if original_only_mine_bool else None)))
+                            **su.get_original_list_args(request.form)))
 
 @app.route('/comment/<int:comment_id>/delete', methods=['POST'])
 @login_required_with_csrf
 def delete_comment_route(comment_id):
     '''Remove comment from device, on device page'''
-    user = db.get_user_by_username(session['username'])
-    if not user:
-        return 'User not found', 403
-
     comment_to_delete = db.get_comment_by_id(comment_id)
     if not comment_to_delete:
         return redirect(url_for('index'))
 
     device_id_for_redirect = comment_to_delete['device_id']
 
-    if db.delete_comment(comment_id, user['id']):
+    if db.delete_comment(comment_id, g.user['id']):
         return redirect(url_for('view_device',
                                 device_id=device_id_for_redirect))
 
@@ -424,5 +556,14 @@ def delete_comment_route(comment_id):
                             device_id=device_id_for_redirect,
                             error='Could not delete comment or not authorized.'))
 
+def start_sweeper():
+    '''end expired reservations in a thread of this process when
+    config.SWEEPER_INTERVAL is set, returns its stop event or None.
+    Called by the serving entry point, importing app starts nothing'''
+    if not config.SWEEPER_INTERVAL:
+        return None
+    return sweeper.start_sweeper(db, config.SWEEPER_INTERVAL, config.SWEEPER_BATCH_SIZE)
+
 if __name__ == '__main__':
+    start_sweeper()
     app.run(debug=True)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+'''ASGI entry point of slotkeeper.
+
+Event long-polls, the event stream and the device list of the JSON API
+are served by async handlers here: a waiting watcher holds no thread and
+database calls run on a bounded thread pool, so one worker keeps
+thousands of dashboards connected. Every other route goes to the Flask
+app of app.py, through asgiref's WsgiToAsgi when it is installed and
+otherwise through a small buffered bridge. The sync mode (flask run or
+any WSGI server on app:app) is unchanged.
+
+    uvicorn asgi:application
+    python asgi.py --port 8000
+'''
+import argparse
+import asyncio
+import contextvars
+import functools
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from itsdangerous import BadSignature
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_cookie
+
+import api
+from app import app as flask_app, db, event_bus, metrics, query_stats, start_sweeper
+import config
+import slotkeeperutil as su
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+class AsyncDatabase:
+    '''Database facade for async handlers.
+
+    Methods of the wrapped Database become coroutines that run on a thread
+    pool of max_workers, sized like the connection pool since more threads
+    would only queue for connections. Calls run in the caller's context,
+    so their SQL statements count for its request.
+    '''
+    def __init__(self, database, max_workers):
+        self._db = database
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='slotkeeper-db')
+
+    async def run(self, fn, *args, **kwargs):
+        '''fn(*args, **kwargs) on the database threads'''
+        loop = asyncio.get_running_loop()
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+    def __getattr__(self, name):
+        method = getattr(self._db, name)
+
+        async def call(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+        return call
+
+    def close(self):
+        '''stop the database threads'''
+        self._executor.shutdown(wait=False)
+
+class WsgiBridge:
+    '''WSGI app as ASGI app for when asgiref is not installed.
+
+    Request body and response are buffered and the app runs on executor
+    threads. Fine for the page routes, the streamed ones are async here.
+    '''
+    def __init__(self, wsgi_app, executor):
+        self._wsgi_app = wsgi_app
+        self._executor = executor
+
+    @staticmethod
+    def environ(scope, body):
+        '''WSGI environ of http scope'''
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+        for name, value in scope.get('headers', []):
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            key = {'content-length': 'CONTENT_LENGTH', 'content-type': 'CONTENT_TYPE'}.get(
+                name, 'HTTP_' + name.upper().replace('-', '_'))
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def run(self, environ):
+        '''call app, returns status, headers and whole body'''
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        result = self._wsgi_app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], body
+
+    async def __call__(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(
+            self._executor, self.run, self.environ(scope, body))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                                for k, v in headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+class Request:
+    '''parts of an http scope async handlers use'''
+    def __init__(self, scope, receive):
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args = MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+        self.cookies = parse_cookie(self.headers.get('cookie', ''))
+        # same as Flask request.full_path, so ETags match in both modes
+        self.full_path = f'{self.path}?{self.query_string}'
+
+async def wait_disconnect(receive):
+    '''returns when client has gone'''
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+class Application:
+    '''ASGI app: async handlers for hot API routes, Flask for the rest'''
+    def __init__(self, wsgi_app, database, db_threads, wsgi_threads, background=None):
+        self.db = AsyncDatabase(database, db_threads)
+        # started on server startup, returns an event that stops it or None
+        self._background = background
+        self._background_stop = None
+        self._wsgi_executor = ThreadPoolExecutor(wsgi_threads,
+                                                 thread_name_prefix='slotkeeper-wsgi')
+        self.wsgi = (WsgiToAsgi(wsgi_app) if WsgiToAsgi
+                     else WsgiBridge(wsgi_app, self._wsgi_executor))
+        self._routes = {
+            '/api/v1/devices': ('asgi.list_devices', self.list_devices),
+            '/api/v1/events': ('asgi.event_stream', self.event_stream),
+            '/api/v1/events/poll': ('asgi.poll_events', self.poll_events)
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif (scope['type'] == 'http' and scope['method'] == 'GET'
+              and scope['path'] in self._routes):
+            await self.handle(scope, receive, send)
+        elif scope['type'] == 'http':
+            await self.wsgi(scope, receive, send)
+        else:
+            await send({'type': 'websocket.close'})
+
+    async def lifespan(self, receive, send):
+        '''startup and shutdown of the server'''
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self._background:
+                    self._background_stop = self._background()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._background_stop:
+                    self._background_stop.set()
+                self.db.close()
+                self._wsgi_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, receive, send):
+        '''run async handler of the route, counted like Flask routes'''
+        endpoint, handler = self._routes[scope['path']]
+        request = Request(scope, receive)
+        start = time.perf_counter()
+        queries = query_stats.begin_request() if query_stats else None
+        status = 500
+
+        async def counted_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if queries is not None and config.QUERY_STATS_DEBUG:
+                    message['headers'] = message['headers'] + [
+                        (b'x-sql-queries', str(queries.count).encode()),
+                        (b'server-timing', f'db;dur={queries.seconds * 1000:.2f}'.encode())]
+                metrics.observe(endpoint, request.method, status,
+                                time.perf_counter() - start,
+                                queries.count if queries else 0,
+                                queries.seconds if queries else 0.0)
+            await send(message)
+
+        try:
+            user = await self.logged_in_user(request)
+            if user is None:
+                await respond(counted_send, 401, {'error': 'Login required.'})
+            else:
+                await handler(request, user, counted_send)
+        finally:
+            if query_stats:
+                query_stats.end_request()
+
+    async def logged_in_user(self, request):
+        '''user of the Flask session cookie, None if not logged in'''
+        cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        if not cookie or serializer is None:
+            return None
+        try:
+            session = serializer.loads(
+                cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+        if session.get('user_id') is not None:
+            return await self.db.get_user_by_id(session['user_id'])
+        if session.get('username'):
+            return await self.db.get_user_by_username(session['username'])
+        return None
+
+    async def list_devices(self, request, user, send):
+        '''GET /api/v1/devices, as api.list_devices'''
+        tables = ('devices', 'reservations')
+        versions = await self.db.get_table_versions()
+        etag = api.etag_of(request.full_path, user['id'], versions, tables)
+        headers = [('cache-control', 'private, no-cache')]
+        if etag:
+            quoted = f'"{etag}"'
+            headers.append(('etag', quoted))
+            if_none_match = request.headers.get('if-none-match', '')
+            if quoted in if_none_match or if_none_match == '*':
+                await respond(send, 304, None, headers)
+                return
+        page = await self.db.run(api.device_page, user['id'], su.get_list_args(request.args))
+        await respond(send, 200, page, headers)
+
+    async def poll_events(self, request, user, send):
+        '''GET /api/v1/events/poll, as api.poll_events without a thread'''
+        after_id = api.event_id_arg(request.args.get('after'))
+        if after_id is None:
+            await respond(send, 200, {'events': [], 'last_id': event_bus.last_id()})
+            return
+        events = await event_bus.wait_async(after_id,
+                                            api.poll_timeout_arg(request.args.get('timeout')))
+        await respond(send, 200, {'events': events,
+                                  'last_id': events[-1]['id'] if events else after_id})
+
+    async def event_stream(self, request, user, send):
+        '''GET /api/v1/events, as api.event_stream without a thread'''
+        after_id = api.event_id_arg(request.headers.get('last-event-id') or
+                                    request.args.get('after'))
+        if after_id is None:
+            after_id = event_bus.last_id()
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n',
+                    'more_body': True})
+        disconnected = asyncio.ensure_future(wait_disconnect(request.receive))
+        try:
+            while True:
+                waiter = asyncio.ensure_future(
+                    event_bus.wait_async(after_id, config.EVENT_KEEPALIVE))
+                await asyncio.wait({waiter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiter.cancel()
+                    await asyncio.wait({waiter})
+                    return
+                events = waiter.result()
+                chunk = ''.join(api.sse_event(event) for event in events) or ': keepalive\n\n'
+                await send({'type': 'http.response.body', 'body': chunk.encode(),
+                            'more_body': True})
+                if events:
+                    after_id = events[-1]['id']
+        finally:
+            disconnected.cancel()
+
+async def respond(send, status, data, headers=()):
+    '''json response, no body for 304'''
+    body = b'' if data is None else json.dumps(data).encode()
+    headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    if data is not None:
+        headers.append((b'content-type', b'application/json'))
+    headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+application = Application(flask_app, db, config.ASGI_DB_THREADS,
+                          config.ASGI_WSGI_THREADS, background=start_sweeper)
+
+def main():
+    '''run application under uvicorn'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        print('uvicorn is not installed (pip install uvicorn), '
+              'or serve asgi:application with any ASGI server')
+        sys.exit(1)
+    uvicorn.run(application, host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
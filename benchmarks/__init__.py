@@ -0,0 +1 @@
+'''benchmarks for slotkeeper, run from repository root with python -m'''
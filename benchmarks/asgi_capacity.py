@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+'''concurrent long-poll capacity of the sync (WSGI) and async (ASGI) modes.
+
+A seeded throwaway database is served in-process in both modes. Sync
+mode runs Flask on a fixed number of threads like a threaded WSGI
+server, async mode calls asgi.application directly. In each mode many
+watchers long-poll /api/v1/events/poll while probe clients load the
+device list, an event is published halfway through the hold time and
+the report shows how many watchers were waiting at once, probe latency
+and how long the event took to reach every watcher.
+
+    python -m benchmarks.asgi_capacity --watchers 1000 --threads 16
+'''
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.routes import percentile
+
+class Tracker:
+    '''watchers waiting now and at most, thread safe'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.peak = 0
+        self.returned = []
+        self.errors = 0
+
+    def enter(self):
+        '''watcher started waiting'''
+        with self._lock:
+            self.waiting += 1
+            self.peak = max(self.peak, self.waiting)
+
+    def leave(self, status):
+        '''watcher got its response'''
+        with self._lock:
+            self.waiting -= 1
+            self.returned.append(time.perf_counter())
+            self.errors += status != 200
+
+def report(mode, tracker, probe_times, published_at, args):
+    '''results of one mode'''
+    probe_times = sorted(probe_times)
+    delivered = [t for t in tracker.returned if t >= published_at]
+    return {
+        'mode': mode,
+        'watchers': args.watchers,
+        'threads': args.threads if mode == 'sync' else None,
+        'watchers_waiting_at_once': tracker.peak,
+        'probe_p50_ms': round(percentile(probe_times, 50) * 1000, 1),
+        'probe_p99_ms': round(percentile(probe_times, 99) * 1000, 1),
+        'event_reached_all_ms': (round((max(delivered) - published_at) * 1000, 1)
+                                 if len(delivered) == args.watchers else None),
+        'errors': tracker.errors
+    }
+
+def session_cookie(flask_app, user_id):
+    '''name and value of a signed Flask session cookie for user_id'''
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    return (flask_app.config['SESSION_COOKIE_NAME'],
+            serializer.dumps({'user_id': user_id, 'csrf_token': 'benchmark'}))
+
+def run_sync(flask_app, event_bus, cookie, args):
+    '''watchers and probes on a fixed size thread pool'''
+    tracker, probe_times = Tracker(), []
+    after = event_bus.last_id()
+
+    def client():
+        test_client = flask_app.test_client()
+        test_client.set_cookie(*cookie)
+        return test_client
+
+    def watch():
+        tracker.enter()
+        response = client().get(f'/api/v1/events/poll?after={after}&timeout={args.hold}')
+        tracker.leave(response.status_code)
+
+    def probe(submitted):
+        client().get('/api/v1/devices')
+        probe_times.append(time.perf_counter() - submitted)
+
+    with ThreadPoolExecutor(args.threads) as pool:
+        start = time.perf_counter()
+        for _ in range(args.watchers):
+            pool.submit(watch)
+        for _ in range(args.probes):
+            pool.submit(probe, time.perf_counter())
+        time.sleep(max(0.0, start + args.hold / 2 - time.perf_counter()))
+        published_at = time.perf_counter()
+        event_bus.publish('benchmark')
+    return report('sync', tracker, probe_times, published_at, args)
+
+async def asgi_get(application, path, query, cookie):
+    '''GET through the ASGI app, returns status'''
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': query.encode(), 'root_path': '',
+        'headers': [(b'host', b'localhost'), (b'cookie', '='.join(cookie).encode())],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 80)
+    }
+    requested = False
+    status = None
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await asyncio.Event().wait()  # client never goes away
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await application(scope, receive, send)
+    return status
+
+async def run_async(application, event_bus, cookie, args):
+    '''watchers and probes as asyncio tasks'''
+    tracker, probe_times = Tracker(), []
+    after = event_bus.last_id()
+
+    async def watch():
+        tracker.enter()
+        tracker.leave(await asgi_get(application, '/api/v1/events/poll',
+                                     f'after={after}&timeout={args.hold}', cookie))
+
+    async def probe():
+        submitted = time.perf_counter()
+        await asgi_get(application, '/api/v1/devices', '', cookie)
+        probe_times.append(time.perf_counter() - submitted)
+
+    tasks = [asyncio.ensure_future(watch()) for _ in range(args.watchers)]
+    tasks += [asyncio.ensure_future(probe()) for _ in range(args.probes)]
+    await asyncio.sleep(args.hold / 2)
+    published_at = time.perf_counter()
+    event_bus.publish('benchmark')
+    await asyncio.gather(*tasks)
+    return report('async', tracker, probe_times, published_at, args)
+
+def main():
+    '''main'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--watchers', type=int, default=1000)
+    parser.add_argument('--probes', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=16,
+                        help='threads of the sync mode server')
+    parser.add_argument('--hold', type=float, default=4.0,
+                        help='long-poll timeout, the event comes at half of it')
+    parser.add_argument('--devices', type=int, default=10_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        subprocess.run([sys.executable, 'seed.py', path, '--users', '100',
+                        '--devices', str(args.devices), '--comments', '5',
+                        '--reservations', '5'],
+                       check=True, stdout=subprocess.DEVNULL)
+        os.environ['SLOTKEEPER_DATABASE'] = path
+        # both bind to SLOTKEEPER_DATABASE on import
+        import asgi
+        import app
+
+        cookie = session_cookie(app.app, 1)
+        results = [run_sync(app.app, app.event_bus, cookie, args),
+                   asyncio.run(run_async(asgi.application, app.event_bus, cookie, args))]
+        app.db.close()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
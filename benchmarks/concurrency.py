@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+'''read and write throughput of Database with growing worker count.
+
+Every worker is its own process with its own Database, like gunicorn
+workers sharing one database file. Workers run a mix of device list
+reads, device lookups, reservations and comments for a fixed time and
+report how many operations succeeded and how many failed on a locked
+database.
+
+    python -m benchmarks.concurrency --workers 1 2 4 8 --seconds 5
+    python -m benchmarks.concurrency --pragmas default
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import config
+from database import Database, RESERVATION_CONFLICT, RESERVATION_CREATED
+
+SCHEMA_PATH = 'schema.sql'
+
+def build_database(path, n_devices):
+    '''schema, a user per worker and n devices'''
+    conn = sqlite3.connect(path)
+    with open(SCHEMA_PATH, encoding='utf-8') as f:
+        conn.executescript(f.read())
+    conn.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                     ((f'worker{i}', 'x') for i in range(64)))
+    conn.executemany(
+        'INSERT INTO devices (name, description, created_by) VALUES (?, ?, 1)',
+        ((f'device{i}', f'description of device {i}') for i in range(n_devices)))
+    conn.commit()
+    conn.close()
+
+def worker(path, pragmas, worker_id, seconds, write_ratio, n_devices, results):
+    '''run operation mix until time is up'''
+    db = Database(path, pool_size=1, pragmas=pragmas)
+    user_id = worker_id + 1
+    rng = random.Random(worker_id)
+    counts = {'reads': 0, 'writes': 0, 'conflicts': 0, 'errors': 0}
+    until = (datetime.now() + timedelta(hours=1)).isoformat()
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        device_id = rng.randint(1, n_devices)
+        try:
+            if rng.random() < write_ratio:
+                if rng.random() < 0.5:
+                    status, _ = db.create_reservation(user_id, device_id, until)
+                    if status == RESERVATION_CONFLICT:
+                        counts['conflicts'] += 1
+                        continue
+                    ok = status == RESERVATION_CREATED
+                else:
+                    ok = db.add_comment(device_id, user_id, 'load test comment')
+                counts['writes' if ok else 'errors'] += 1
+            else:
+                if rng.random() < 0.5:
+                    db.search_devices(user_id=user_id, page=rng.randint(1, 10))
+                else:
+                    db.get_device_by_id(device_id)
+                counts['reads'] += 1
+        except sqlite3.OperationalError:
+            counts['errors'] += 1
+    db.close()
+    results.put(counts)
+
+def run(path, pragmas, n_workers, seconds, write_ratio, n_devices):
+    '''start workers at once and sum their results'''
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=worker,
+                                     args=(path, pragmas, i, seconds, write_ratio,
+                                           n_devices, results))
+             for i in range(n_workers)]
+    for proc in procs:
+        proc.start()
+    totals = {'reads': 0, 'writes': 0, 'conflicts': 0, 'errors': 0}
+    for _ in procs:
+        for key, value in results.get().items():
+            totals[key] += value
+    for proc in procs:
+        proc.join()
+
+    return {
+        'workers': n_workers,
+        'reads_per_s': round(totals['reads'] / seconds, 1),
+        'writes_per_s': round(totals['writes'] / seconds, 1),
+        'conflicts': totals['conflicts'],
+        'errors': totals['errors']
+    }
+
+def main():
+    '''main'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    parser.add_argument('--devices', type=int, default=10_000)
+    parser.add_argument('--pragmas', choices=['config', 'default'], default='config',
+                        help='config.DB_PRAGMAS or sqlite defaults (rollback journal)')
+    args = parser.parse_args()
+    pragmas = config.DB_PRAGMAS if args.pragmas == 'config' else {}
+
+    results = []
+    for n_workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            build_database(path, args.devices)
+            results.append(run(path, pragmas, n_workers, args.seconds,
+                               args.write_ratio, args.devices))
+    print(json.dumps({'pragmas': pragmas, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''hot Database queries must use the index they were written for.
+
+Builds a throwaway database with reservation history, runs each hot
+Database method with SQL tracing on and checks EXPLAIN QUERY PLAN of the
+traced statement has the index lookups it was written for and none of
+the full scans it was written to avoid. Exits non-zero if any query has
+lost its index, e.g. after a schema change.
+
+    python -m benchmarks.query_plans --reservations 100000
+'''
+import argparse
+from datetime import datetime
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.search_plan import add_reservations, build_database
+from database import Database
+
+def traced_statements(db, call):
+    '''sql statements run by call(), expanded with their parameters'''
+    statements = []
+    # pool of one connection, the trace callback stays on it for the call
+    with db._connect() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        with db._connect() as conn:
+            conn.set_trace_callback(None)
+    return statements
+
+def query_plan(db, sql):
+    '''EXPLAIN QUERY PLAN lines of sql'''
+    with db._connect() as conn:
+        return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+def hot_queries(now):
+    '''(name, call, marker in sql text, plan lines that must be there,
+    plan lines that must not)'''
+    future = datetime.fromtimestamp(now + 86400).isoformat()
+    return [
+        ('search page reservations', lambda db: db.search_devices(user_id=1),
+         'WITH page AS',
+         ('SEARCH r_first USING INDEX idx_reservations_device_live',
+          'SEARCH r_mine USING INDEX idx_reservations_device_live'), ()),
+        ('my reservations filter', lambda db: db.search_devices(user_id=1, owned=True),
+         'WITH page AS',
+         ('SEARCH r_check USING INDEX idx_reservations_user_live',), ('SCAN r_check',)),
+        # r*tree index 2 is a range search, C0 is starts_at < ? and E1 ends_at > ?
+        ('free time filter',
+         lambda db: db.search_devices(user_id=1, free_between=(now, now + 3600)),
+         'WITH page AS',
+         ('SCAN ri VIRTUAL TABLE INDEX 2:C0E1',
+          'SEARCH r_busy USING INTEGER PRIMARY KEY'), ('SCAN r_busy',)),
+        ('active reservation of device', lambda db: db.get_active_reservation_for_device(1),
+         'FROM reservations r',
+         ('SEARCH r USING INDEX idx_reservations_device_live',), ()),
+        ('reservation overlap check', lambda db: db.create_reservation(1, 2, future),
+         'r.starts_at < ',
+         ('SEARCH r USING INDEX idx_reservations_device_live',), ()),
+        ('active reservations of user', lambda db: db.get_active_reservations_by_user(1),
+         'FROM reservations r',
+         ('SEARCH r USING INDEX idx_reservations_user_live',), ()),
+        ('last reservations of user', lambda db: db.get_last_reservations_by_user(1),
+         'FROM reservations r',
+         ('SEARCH r USING INDEX idx_reservations_user_created_at',), ()),
+        ('expired reservations', lambda db: db.end_expired_reservations(),
+         'UPDATE reservations',
+         ('SEARCH reservations USING INDEX idx_reservations_expiry',), ()),
+        ('user usage rollup', lambda db: db.get_user_device_reservations(1),
+         'user_device_usage',
+         ('SEARCH u USING PRIMARY KEY (user_id=?)',), ()),
+        ('next reservation change', lambda db: db.get_table_versions(),
+         'MIN(moment)',
+         ('SEARCH reservations USING INDEX idx_reservations_expiry',
+          'SEARCH reservations USING INDEX idx_reservations_starts'), ()),
+        ('device comment page', lambda db: db.get_comment_page(1, before=(now, 1)),
+         'FROM comments c',
+         ('SEARCH c USING INDEX idx_comments_device_created_at',), ()),
+    ]
+
+def main():
+    '''main'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=1_000)
+    parser.add_argument('--reservations', type=int, default=100_000)
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'plans.db')
+        conn = build_database(path, args.devices)
+        add_reservations(conn, args.reservations, args.devices, 0)
+        conn.execute('ANALYZE')
+        conn.commit()
+        conn.close()
+
+        db = Database(path, pool_size=1)
+        for name, call, marker, expected, unwanted in hot_queries(int(time.time())):
+            statements = [s for s in traced_statements(db, lambda: call(db)) if marker in s]
+            plan = query_plan(db, statements[0]) if statements else []
+            missing = [want for want in expected
+                       if not any(want in line for line in plan)]
+            found = [avoid for avoid in unwanted
+                     if any(avoid in line for line in plan)]
+            ok = not missing and not found
+            status = 'ok  ' if ok else 'FAIL'
+            wanted = ', '.join(expected)
+            print(f'{status} {name}: {wanted}')
+            for want in missing:
+                print('        missing:', want)
+            for avoid in found:
+                print('        unwanted:', avoid)
+            if not ok:
+                failures.append(name)
+                for line in plan or ['query not run']:
+                    print('       ', line)
+        db.close()
+
+    if failures:
+        print('queries not using their index:', ', '.join(failures), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
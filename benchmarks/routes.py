@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+'''end to end latency of Flask routes and Database methods at several scales.
+
+For every scale a throwaway database is seeded with seed.py (users and
+devices equal to the scale) and measured in a child process pointed at it
+with SLOTKEEPER_DATABASE. The child drives the routes through the Flask
+test client as a logged in user and calls Database methods directly,
+recording latency percentiles and SQL statements per call. Results are
+printed as JSON, save one run per commit and compare them.
+
+    python -m benchmarks.routes --scales 1000 10000 100000 > before.json
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from database import RESERVATION_CREATED, RESERVATION_FAILED
+
+def percentile(samples, p):
+    '''nearest rank percentile of sorted samples'''
+    return samples[min(len(samples) - 1, max(0, round(p / 100 * len(samples)) - 1))]
+
+def summary(timings, queries, failures):
+    '''latency percentiles in ms and mean statements per call'''
+    timings = sorted(timings)
+    return {
+        'calls': len(timings),
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p95_ms': round(percentile(timings, 95) * 1000, 3),
+        'p99_ms': round(percentile(timings, 99) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'queries': round(sum(queries) / len(queries), 2),
+        'failures': failures
+    }
+
+class QueryCounter:
+    '''sqlite trace callback counting statements, transaction control excluded'''
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, sql):
+        # statements run inside triggers and virtual tables (FTS5 reading its
+        # own shadow tables) are traced as '-- ...', they are not ours
+        sql = sql.lstrip()
+        if sql.startswith('--'):
+            return
+        if not sql.upper().startswith(('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA')):
+            self.count += 1
+
+def trace_pool(db, counter):
+    '''open every pooled connection of db and trace it into counter'''
+    pool = db._pool
+    conns = [pool.acquire() for _ in range(pool.max_size)]
+    for conn in conns:
+        conn.set_trace_callback(counter)
+    for conn in conns:
+        pool.release(conn)
+
+def measure(cases, counter, repeats, warmup=5):
+    '''run every case repeats times, case(rng) prepares and returns the timed call'''
+    results = {}
+    rng = random.Random(1)
+    for name, case in cases:
+        timings, queries, failures = [], [], 0
+        for i in range(warmup + repeats):
+            call = case(rng)
+            counter.count = 0
+            start = time.perf_counter()
+            ok = call()
+            elapsed = time.perf_counter() - start
+            if i < warmup:
+                continue
+            timings.append(elapsed)
+            queries.append(counter.count)
+            failures += 1 if ok is False else 0
+        results[name] = summary(timings, queries, failures)
+    return results
+
+def reserved_device(db, rng, n_devices, user_id):
+    '''reserve a random free device for user for an hour, returns reservation id'''
+    until = datetime.fromtimestamp(time.time() + 3600).isoformat()
+    while True:
+        device_id = rng.randint(1, n_devices)
+        if db.create_reservation(user_id, device_id, until)[0] == RESERVATION_CREATED:
+            return db.get_active_reservation_for_device(device_id)['id']
+
+def route_cases(client, db, n_devices, user_id):
+    '''(name, case) for the routes of a logged in user'''
+    def token():
+        with client.session_transaction() as session:
+            return session['csrf_token']
+
+    def ok(response):
+        return response.status_code < 400
+
+    def device(rng):
+        return rng.randint(1, n_devices)
+
+    def until(hours=1):
+        return datetime.fromtimestamp(time.time() + hours * 3600).strftime('%Y-%m-%dT%H:%M')
+
+    def get(url):
+        return lambda rng: lambda: ok(client.get(url(rng) if callable(url) else url))
+
+    def reserve(rng):
+        device_id, data = device(rng), {'reserved_until': until(), 'csrf_token': token()}
+        return lambda: ok(client.post(f'/reserve/{device_id}', data=data))
+
+    def cancel(rng):
+        reservation_id = reserved_device(db, rng, n_devices, user_id)
+        data = {'csrf_token': token()}
+        return lambda: ok(client.post(f'/cancel_reservation/{reservation_id}', data=data))
+
+    def add_comment(rng):
+        device_id = device(rng)
+        data = {'comment_content': 'benchmark comment', 'csrf_token': token()}
+        return lambda: ok(client.post(f'/device/{device_id}/add_comment', data=data))
+
+    def api_not_modified(rng):
+        etag = client.get('/api/v1/devices').headers.get('ETag')
+        return lambda: client.get('/api/v1/devices',
+                                  headers={'If-None-Match': etag}).status_code == 304
+
+    free_from, free_until = until(24), until(26)
+    return [
+        ('index', get('/')),
+        ('index_page', get(lambda rng: f'/?page={rng.randint(1, 5)}')),
+        ('index_search', get('/?q=probe')),
+        ('index_free_filter', get(f'/?free_from={free_from}&free_until={free_until}')),
+        ('view_device', get(lambda rng: f'/device/{device(rng)}')),
+        ('device_comments', get(lambda rng: f'/device/{device(rng)}/comments')),
+        ('reserve_form', get(lambda rng: f'/reserve/{device(rng)}')),
+        ('reserve', reserve),
+        ('cancel_reservation', cancel),
+        ('user_page', get('/user')),
+        ('add_comment', add_comment),
+        ('api_devices', get('/api/v1/devices')),
+        ('api_devices_not_modified', api_not_modified),
+    ]
+
+def method_cases(db, n_devices, user_id):
+    '''(name, case) calling Database methods directly'''
+    def device(rng):
+        return rng.randint(1, n_devices)
+
+    def call(method, *args, **kwargs):
+        # callable arguments are drawn per call, e.g. a random device id
+        def case(rng):
+            values = [arg(rng) if callable(arg) else arg for arg in args]
+            return lambda: method(*values, **kwargs)
+        return case
+
+    def create_reservation(rng):
+        device_id = device(rng)
+        until = datetime.fromtimestamp(time.time() + 3600).isoformat()
+        return lambda: db.create_reservation(user_id, device_id, until)[0] != RESERVATION_FAILED
+
+    def cancel_reservation(rng):
+        reservation_id = reserved_device(db, rng, n_devices, user_id)
+        return lambda: db.cancel_reservation(reservation_id)
+
+    now = int(time.time())
+    return [
+        ('search_devices', call(db.search_devices, user_id=user_id)),
+        ('search_devices_query', call(db.search_devices, 'probe', user_id, ranked=True)),
+        ('search_devices_owned', call(db.search_devices, user_id=user_id, owned=True)),
+        ('search_devices_free', call(db.search_devices, user_id=user_id,
+                                     free_between=(now + 86400, now + 93600))),
+        ('get_device_by_id', call(db.get_device_by_id, device)),
+        ('get_active_reservation_for_device', call(db.get_active_reservation_for_device, device)),
+        ('get_comment_page', call(db.get_comment_page, device)),
+        ('get_user_dashboard', call(db.get_user_dashboard, user_id)),
+        ('get_overlapping_reservations', call(db.get_overlapping_reservations,
+                                              now, now + 3600)),
+        ('get_table_versions', call(db.get_table_versions)),
+        ('create_reservation', create_reservation),
+        ('cancel_reservation', cancel_reservation),
+        ('add_comment', call(db.add_comment, device, user_id, 'benchmark comment')),
+    ]
+
+def run_scale(repeats):
+    '''measure routes and methods against SLOTKEEPER_DATABASE, in child process'''
+    import app  # binds its Database to SLOTKEEPER_DATABASE on import
+
+    counter = QueryCounter()
+    trace_pool(app.db, counter)
+    with sqlite3.connect(app.DATABASE) as conn:
+        n_devices = conn.execute('SELECT MAX(id) FROM devices').fetchone()[0]
+        user_id = 1
+
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['username'] = 'user1'
+        session['csrf_token'] = 'benchmark'
+
+    return {
+        'routes': measure(route_cases(client, app.db, n_devices, user_id), counter, repeats),
+        'methods': measure(method_cases(app.db, n_devices, user_id), counter, repeats)
+    }
+
+def seed(path, scale, args):
+    '''seed throwaway database with seed.py'''
+    subprocess.run(
+        [sys.executable, 'seed.py', path,
+         '--users', str(scale), '--devices', str(scale),
+         '--comments', str(args.comments), '--reservations', str(args.reservations),
+         '--workers', str(args.workers)],
+        check=True, stdout=subprocess.DEVNULL)
+
+def git_commit():
+    '''current commit of the working tree, None outside git'''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    '''main'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--comments', type=int, default=20, help='average comments per device')
+    parser.add_argument('--reservations', type=int, default=20,
+                        help='average reservations per device')
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scale(args.repeats)))
+        return
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'scales': {}
+    }
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            print(f'Seeding {scale} users and devices...', file=sys.stderr)
+            seed(path, scale, args)
+            print(f'Measuring {scale}...', file=sys.stderr)
+            child = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.routes', '--child',
+                 '--repeats', str(args.repeats)],
+                env=dict(os.environ, SLOTKEEPER_DATABASE=path),
+                check=True, stdout=subprocess.PIPE, text=True)
+            results['scales'][str(scale)] = json.loads(child.stdout.splitlines()[-1])
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
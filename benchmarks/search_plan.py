@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''search_devices must not get slower when reservation history grows.
+
+Builds a throwaway database with a fixed number of devices, grows the
+reservations table step by step and times the first device list page at
+each size. The query plan of the page query is checked too: reservations
+may only be reached through an index, never by scanning the table.
+
+    python -m benchmarks.search_plan --devices 10000 --reservations 10000 100000 1000000
+'''
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from database import Database
+
+SCHEMA_PATH = 'schema.sql'
+
+def build_database(path, n_devices):
+    '''schema, one user and n devices'''
+    conn = sqlite3.connect(path)
+    with open(SCHEMA_PATH, encoding='utf-8') as f:
+        conn.executescript(f.read())
+    conn.execute("INSERT INTO users (username, password_hash) VALUES ('bench', 'x')")
+    conn.executemany(
+        'INSERT INTO devices (name, description, created_by) VALUES (?, ?, 1)',
+        ((f'device{i}', f'description of device {i}') for i in range(n_devices)))
+    conn.commit()
+    return conn
+
+def add_reservations(conn, n, n_devices, first):
+    '''mostly ended history with every 50th reservation still active'''
+    now = int(time.time())
+    rows = []
+    for i in range(first, first + n):
+        device_id = i % n_devices + 1
+        if i % 50 == 0:
+            rows.append((1, device_id, now + 3600 + i % 7200, now - 60, None))
+        else:
+            rows.append((1, device_id, now - 3600, now - 7200, now - 3600))
+    conn.executemany(
+        '''INSERT INTO reservations (user_id, device_id, reserved_until, created_at, ended_at)
+           VALUES (?, ?, ?, ?, ?)''', rows)
+    conn.commit()
+
+def page_query_plan(db, path):
+    '''EXPLAIN QUERY PLAN lines of the search_devices page query'''
+    statements = []
+    # pool of one connection, the trace callback stays on it for the search
+    with db._connect() as conn:
+        conn.set_trace_callback(statements.append)
+    db.search_devices(user_id=1)
+    with db._connect() as conn:
+        conn.set_trace_callback(None)
+
+    page_sql = next(s for s in statements if 'WITH page AS' in s)
+    conn = sqlite3.connect(path)
+    plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + page_sql)]
+    conn.close()
+    return plan
+
+def time_first_page(db, repeats):
+    '''median seconds of first page search'''
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        db.search_devices(user_id=1)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def main():
+    '''main'''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=10_000)
+    parser.add_argument('--reservations', type=int, nargs='+',
+                        default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+
+    results = []
+    scans = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        conn = build_database(path, args.devices)
+        total = 0
+        for target in sorted(args.reservations):
+            add_reservations(conn, target - total, args.devices, total)
+            total = target
+            conn.execute('ANALYZE')
+            conn.commit()
+
+            db = Database(path, pool_size=1)
+            db.search_devices(user_id=1)
+            plan = page_query_plan(db, path)
+            scans.extend(line for line in plan if line.startswith('SCAN r'))
+            results.append({
+                'reservations': total,
+                'median_ms': round(time_first_page(db, args.repeats) * 1000, 3),
+                'plan': plan
+            })
+            db.close()
+        conn.close()
+
+    print(json.dumps(results, indent=2))
+    if scans:
+        print('reservations table is scanned:', scans, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,88 @@
 '''config module for slotkeeper'''
+import os
+
 SECRET_KEY = 'super_secret_key'
+
+# database file, SLOTKEEPER_DATABASE points benchmarks and tools elsewhere
+DATABASE = os.environ.get('SLOTKEEPER_DATABASE', 'database.db')
+
+# Database connection pool, size it to the number of threads per WSGI worker
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 5.0
+# connection level PRAGMAs, applied once when pooled connection is opened.
+# WAL lets readers run while a worker writes, NORMAL sync is safe with WAL,
+# busy_timeout (ms) waits for write lock instead of failing at once,
+# cache_size is negative KiB per connection and mmap_size bytes
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY'
+}
+# write transactions still locked out after busy_timeout are retried this
+# many times, sleeping DB_WRITE_BACKOFF * 2^attempt seconds with jitter
+DB_WRITE_RETRIES = 5
+DB_WRITE_BACKOFF = 0.05
+
+# every SQL statement is timed and counted per request for /metrics.
+# Statements slower than SLOW_QUERY_SECONDS are logged, with their query
+# plan once per SLOW_QUERY_EXPLAIN_INTERVAL
+QUERY_STATS = True
+# development only: counts per request in X-SQL-Queries and Server-Timing
+# headers and normalized SQL with pool stats in /api/v1/debug/queries,
+# which any logged in user could read
+QUERY_STATS_DEBUG = False
+SLOW_QUERY_SECONDS = 0.1
+SLOW_QUERY_EXPLAIN_INTERVAL = 60.0
+
+# /metrics serves route latency, status, pool, cache and SQL metrics for
+# Prometheus without login, keep it reachable only from the monitoring side
+METRICS = True
+
+# ASGI mode (asgi.py): database calls of the async API handlers run on
+# ASGI_DB_THREADS threads, no use going past the connection pool. Flask
+# routes run on ASGI_WSGI_THREADS threads unless asgiref is installed
+ASGI_DB_THREADS = DB_POOL_SIZE
+ASGI_WSGI_THREADS = 16
+
+# devices per list page, page cost no longer grows with per device queries
+ITEMS_PER_PAGE = 10
+
+# device list page behind reserve and device modals is reused from the
+# last list view of the user for this many seconds instead of searched again
+LIST_CACHE_TTL = 10.0
+LIST_CACHE_SIZE = 1024
+
+# comments shown at first in device view, older ones are loaded on demand
+COMMENTS_PER_PAGE = 20
+
+# filtered device list totals are cached per search for this many seconds
+COUNT_CACHE_TTL = 30.0
+# stop counting search results past this, list shows 'many' pages instead
+COUNT_LIMIT = 10000
+
+# order device searches by full-text relevance instead of device id
+SEARCH_RANKED = True
+
+# users resolved by id are kept across requests in LRU cache of this size
+USER_CACHE_SIZE = 1024
+
+# expired reservations get ended_at stamped by sweeper.py every this many
+# seconds in a thread started by 'python app.py' or ASGI startup, 0 leaves
+# it to a separate 'python sweeper.py' process, as do other WSGI servers.
+# Batch is one short write transaction
+SWEEPER_INTERVAL = 60.0
+SWEEPER_BATCH_SIZE = 500
+
+# latest change events kept for /api/v1/events watchers to catch up from,
+# long-poll waits at most EVENT_POLL_TIMEOUT and the stream sends a
+# keepalive comment every EVENT_KEEPALIVE seconds without changes
+EVENT_BUFFER_SIZE = 1000
+EVENT_POLL_TIMEOUT = 25.0
+EVENT_KEEPALIVE = 15.0
+
+# rendered device card heads and user page charts are kept in LRU cache of
+# at most this many characters, entries follow device version and rollup
+FRAGMENT_CACHE_CHARS = 4_000_000
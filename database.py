@@ -1,314 +1,902 @@
 '''database module for slotkeeper app'''
+import queue
+import random
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+from slotkeepercache import LRUCache, TTLCache
+
+def fts_match_query(query):
+    '''FTS5 MATCH expression where every word of query is a prefix token'''
+    tokens = re.findall(r'\w+', query)
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+RESERVATION_CREATED = 'created'
+RESERVATION_CONFLICT = 'conflict'
+RESERVATION_FAILED = 'failed'
+
+# key of get_table_versions() for the next start or end of a live reservation
+NEXT_RESERVATION_CHANGE = 'reservations:next_change'
+
+def is_locked_error(error):
+    '''sqlite error raised when another connection holds the write lock'''
+    message = str(error)
+    return 'database is locked' in message or 'database is busy' in message
+
+class PoolTimeout(sqlite3.OperationalError):
+    '''no pooled connection became free in time'''
+
+class PooledConnection(sqlite3.Connection):
+    '''sqlite connection of the pool, reports statements to its sql_trace'''
+    sql_trace = None
+
+    def execute(self, sql, parameters=(), /):
+        if self.sql_trace is not None:
+            self.sql_trace(sql, parameters)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters, /):
+        if self.sql_trace is not None:
+            self.sql_trace(sql, ())
+        return super().executemany(sql, parameters)
+
+    def commit(self):
+        if self.sql_trace is not None:
+            self.sql_trace('COMMIT', ())
+        super().commit()
+
+    def rollback(self):
+        if self.sql_trace is not None:
+            self.sql_trace('ROLLBACK', ())
+        super().rollback()
+
+class ConnectionPool:
+    '''Bounded pool of sqlite connections shared by all request threads'''
+    def __init__(self, db_path, max_size=8, timeout=5.0, pragmas=None, check_after=30.0):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._pragmas = dict(pragmas or {})
+        self._check_after = check_after
+        # LIFO keeps the hottest connections (and their page caches) in use
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._size = 0
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'waited': 0,
+            'timeouts': 0,
+            'discarded': 0,
+            'in_use': 0,
+            'peak_in_use': 0
+        }
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               factory=PooledConnection)
+        conn.row_factory = sqlite3.Row
+        for name, value in self._pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _reserve_slot(self):
+        with self._lock:
+            if self._size >= self.max_size:
+                return False
+            self._size += 1
+            self._stats['created'] += 1
+            return True
+
+    def _drop(self, conn):
+        with self._lock:
+            self._size -= 1
+            self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _healthy(self, conn, idle_since):
+        if time.monotonic() - idle_since < self._check_after:
+            return True
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        '''take connection from the pool, open a new one if there is room'''
+        try:
+            conn, idle_since = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn, reused = None, False
+
+        if conn is None and self._reserve_slot():
+            try:
+                conn = self._open()
+            except sqlite3.Error:
+                with self._lock:
+                    self._size -= 1
+                raise
+
+        if conn is None:
+            with self._lock:
+                self._stats['waited'] += 1
+            try:
+                conn, idle_since = self._idle.get(timeout=self.timeout)
+                reused = True
+            except queue.Empty as e:
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise PoolTimeout(
+                    f'no free database connection in {self.timeout}s '
+                    f'(pool size {self.max_size})') from e
+
+        if reused and not self._healthy(conn, idle_since):
+            self._drop(conn)
+            return self.acquire()
+
+        with self._lock:
+            if reused:
+                self._stats['reused'] += 1
+            self._stats['in_use'] += 1
+            self._stats['peak_in_use'] = max(self._stats['peak_in_use'],
+                                             self._stats['in_use'])
+        return conn
+
+    def release(self, conn):
+        '''return connection to the pool, unfinished transaction is rolled back'''
+        with self._lock:
+            self._stats['in_use'] -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._drop(conn)
+            return
+        self._idle.put((conn, time.monotonic()))
+
+    def stats(self):
+        '''snapshot of pool counters'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+        stats['max_size'] = self.max_size
+        stats['idle'] = self._idle.qsize()
+        return stats
+
+    def close(self):
+        '''close all idle connections'''
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._size -= 1
+            conn.close()
+
 class Database:
-    '''All database activity happen only here'''
-    def __init__(self, db_path, pagesize=10):
+    '''All database activity happen only here. The database must be at the
+    current schema.sql, older ones are brought up to date with migrate.py'''
+    def __init__(self, db_path, pagesize=10, pool_size=8, pool_timeout=5.0, pragmas=None,
+                 count_ttl=30.0, count_limit=None, user_cache_size=1024,
+                 write_retries=5, write_backoff=0.05, query_stats=None):
         self.db_path = db_path
+        # querystats.QueryStats timing every statement, None leaves them untraced
+        self.query_stats = query_stats
+        self._write_retries = write_retries
+        self._write_backoff = write_backoff
         self._pagesize = pagesize
-
+        self._pool = ConnectionPool(db_path, pool_size, pool_timeout, pragmas)
+        # filtered totals per (query, owned, user_id), cleared on writes
+        self._count_cache = TTLCache(count_ttl)
+        self._count_limit = count_limit
+        # users by id across requests, dropped when the user row changes
+        self._user_cache = LRUCache(user_cache_size)
+        self._listeners = []
+
+    @contextmanager
     def _connect(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        conn = self._pool.acquire()
+        trace = self.query_stats.trace(conn) if self.query_stats else None
+        try:
+            yield conn
+        finally:
+            if trace:
+                trace.finish(conn)
+            self._pool.release(conn)
+
+    def _write(self, work):
+        '''run work(conn) in BEGIN IMMEDIATE transaction and commit.
+
+        The write lock is taken up front so the transaction never has to
+        upgrade a read snapshot, and busy_timeout handles short waits. If
+        the lock is still held after that, whole transaction is retried
+        with jittered exponential backoff.
+        '''
+        for attempt in range(self._write_retries + 1):
+            with self._connect() as conn:
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    result = work(conn)
+                    conn.commit()
+                    return result
+                except sqlite3.OperationalError as e:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    if not is_locked_error(e) or attempt == self._write_retries:
+                        raise
+            time.sleep(self._write_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        return None
+
+    def add_listener(self, listener):
+        '''call listener(kind, **data) after each committed change'''
+        self._listeners.append(listener)
+
+    def __notify(self, kind, **data):
+        for listener in self._listeners:
+            try:
+                listener(kind, **data)
+            except Exception as e:  # a broken listener must not fail the write
+                print('Change listener failed:', e)
+
+    def pool_stats(self):
+        '''connection pool statistics'''
+        return self._pool.stats()
+
+    def close(self):
+        '''close pooled connections'''
+        self._pool.close()
+
+    def count_cache_stats(self):
+        '''filtered device count cache statistics'''
+        return self._count_cache.stats()
+
+    def user_cache_stats(self):
+        '''user by id cache statistics'''
+        return self._user_cache.stats()
+
+    def get_table_versions(self):
+        '''{table name: change counter} from table_versions, {} if they
+        can not be read.
+
+        What reads of reservations return also changes with the clock, when
+        a booking starts or runs out. NEXT_RESERVATION_CHANGE holds the
+        next such moment, None when no live reservation has one ahead.
+        '''
+        with self._connect() as conn:
+            try:
+                versions = dict(conn.execute(
+                    'SELECT name, version FROM table_versions').fetchall())
+                # both ends seek one row from a partial index on live reservations
+                versions[NEXT_RESERVATION_CHANGE] = conn.execute(
+                    '''SELECT MIN(moment) FROM (
+                           SELECT MIN(reserved_until) AS moment FROM reservations
+                           WHERE ended_at IS NULL AND reserved_until > strftime('%s', 'now')
+                           UNION ALL
+                           SELECT MIN(starts_at) FROM reservations
+                           WHERE ended_at IS NULL AND starts_at > strftime('%s', 'now')
+                       )''').fetchone()[0]
+                return versions
+            except sqlite3.OperationalError:
+                return {}
 
     def create_user(self, username, password_hash):
         '''add new user to database'''
-        conn = self._connect()
         try:
-            conn.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)',
-                         (username, password_hash))
-            conn.commit()
+            cursor = self._write(lambda conn: conn.execute(
+                'INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                (username, password_hash)))
+            self._user_cache.pop(cursor.lastrowid)
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            conn.close()
+
+    def get_user_by_id(self, user_id):
+        '''get user with id from db, served from cache when possible'''
+        user = self._user_cache.get(user_id)
+        if user is None:
+            with self._connect() as conn:
+                user = conn.execute(
+                    '''SELECT id, username, created_at
+                       FROM users
+                       WHERE id = ?''',
+                    (user_id,)).fetchone()
+            if user:
+                self._user_cache.set(user_id, user)
+        return user
 
     def get_user_by_username(self, username):
         '''get user with username from db'''
-        conn = self._connect()
-        user = conn.execute(
-            '''SELECT id, username, password_hash, created_at
-               FROM users
-               WHERE username = ?''',
-            (username,)).fetchone()
-        conn.close()
-        return user
+        with self._connect() as conn:
+            return conn.execute(
+                '''SELECT id, username, password_hash, created_at
+                   FROM users
+                   WHERE username = ?''',
+                (username,)).fetchone()
 
     def add_device(self, name, description, created_by):
         '''add new device to database'''
-        conn = self._connect()
         try:
-            conn.execute(
+            device_id = self._write(lambda conn: conn.execute(
                 'INSERT INTO devices (name, description, created_by) VALUES (?, ?, ?)',
-                (name, description, created_by)
-            )
-            conn.commit()
+                (name, description, created_by)).lastrowid)
+            self._count_cache.clear()
+            self.__notify('device_added', device_id=device_id)
             return True
         except sqlite3.Error as e:
             print('Error adding device:', e)
             return False
-        finally:
-            conn.close()
 
     def get_device_by_id(self, device_id):
         '''get device from db by id'''
-        conn = self._connect()
-        device = conn.execute(
-            '''SELECT d.id, d.name, d.description, d.created_by, d.created_at,
-               u.username AS creator_username
-               FROM devices d
-               JOIN users u ON d.created_by = u.id
-               WHERE d.id = ?''', (device_id,)).fetchone()
-        conn.close()
-        return device
+        with self._connect() as conn:
+            return conn.execute(
+                '''SELECT d.id, d.name, d.description, d.created_by, d.created_at,
+                   u.username AS creator_username
+                   FROM devices d
+                   JOIN users u ON d.created_by = u.id
+                   WHERE d.id = ?''', (device_id,)).fetchone()
 
     def update_device(self, device_id, name, description):
         '''update device in db by id'''
-        conn = self._connect()
-        conn.execute('UPDATE devices SET name = ?, description = ? WHERE id = ?',
-                     (name, description, device_id)
-        )
-        conn.commit()
-        conn.close()
+        self._write(lambda conn: conn.execute(
+            'UPDATE devices SET name = ?, description = ?, version = version + 1 WHERE id = ?',
+            (name, description, device_id)))
+        self._count_cache.clear()
+        self.__notify('device_updated', device_id=device_id)
 
     def delete_device(self, device_id):
         '''delete device from db by id'''
-        conn = self._connect()
-        conn.execute('DELETE FROM devices WHERE id = ?', (device_id,))
-        conn.commit()
-        conn.close()
-
-    def __get_clauses(self, owned, user_id, params):
-        clauses = ['(d.name LIKE ? OR d.description LIKE ?)']
+        self._write(lambda conn: conn.execute('DELETE FROM devices WHERE id = ?', (device_id,)))
+        self._count_cache.clear()
+        self.__notify('device_deleted', device_id=device_id)
+
+    def __overlap_sql(self, params, starts_at, ends_at, columns='r_busy.device_id'):
+        # reservations overlapping [starts_at, ends_at), ended ones included.
+        # r*tree boxes are rounded outwards, exact check against reservations
+        params.extend([ends_at, starts_at, ends_at, starts_at])
+        return f'''SELECT {columns}
+                   FROM reservation_intervals ri
+                   JOIN reservations r_busy ON r_busy.id = ri.id
+                   WHERE ri.starts_at < ? AND ri.ends_at > ?
+                   AND r_busy.starts_at < ?
+                   AND COALESCE(r_busy.ended_at, r_busy.reserved_until) > ?
+                   AND COALESCE(r_busy.ended_at, r_busy.reserved_until) > r_busy.starts_at'''
+
+    def __get_clauses(self, query, match, owned, user_id, params, free_between=None):
+        clauses = []
+
+        if match:
+            clauses.append('d.id IN (SELECT rowid FROM devices_fts WHERE devices_fts MATCH ?)')
+            params.append(match)
+        elif query:
+            # nothing to MATCH in a query of only punctuation
+            clauses.append('(d.name LIKE ? OR d.description LIKE ?)')
+            params.extend([f'%{query}%', f'%{query}%'])
 
         if owned and user_id:
+            # driven by the few live reservations of user in idx_reservations_user_live,
+            # bookings that have not started count too and show on the device card
             clauses.append(
-                '''EXISTS (
-                   SELECT 1 FROM reservations r_check
-                   WHERE r_check.device_id = d.id
-                   AND r_check.user_id = ?
+                '''d.id IN (
+                   SELECT r_check.device_id FROM reservations r_check
+                   WHERE r_check.user_id = ?
                    AND r_check.reserved_until > strftime('%s', 'now')
                    AND r_check.ended_at IS NULL
                    )''')
             params.append(user_id)
 
-        return clauses
-
-    def __get_items(self, count_sql, params, query_params, sql):
-        conn = self._connect()
-
-        try:
-            count_cursor = conn.execute(count_sql, params)
-            total = count_cursor.fetchone()[0]
-
-            cursor = conn.execute(sql, query_params)
-            items = [dict(row) for row in cursor.fetchall()]
-
-            return {
-                'total': total,
-                'items': items
-            }
+        if free_between:
+            busy_sql = self.__overlap_sql(params, *free_between)
+            clauses.append(f'd.id NOT IN ({busy_sql})')
 
-        except sqlite3.Error as e:
-            print('search_devices failed:', e)
-            return {
-                'total': 0,
-                'items': []
-            }
-        finally:
-            conn.close()
-
-
-    def search_devices(self, query=None, user_id=None, owned=False, page=1):
-        '''search device from db with page limit'''
-        search = f'%{query}%' if query else '%'
-        params = [search, search]
-
-        where_sql = ' AND '.join(self.__get_clauses(owned, user_id, params))
-
-        # COUNT query
-        count_sql = f'SELECT COUNT(*) FROM devices d WHERE {where_sql};'
+        return clauses
 
-        # main query
+    def __count_devices(self, conn, count_key, where_sql, params):
+        # unfiltered total is kept up to date by triggers in table_counts
+        if count_key == ('', False, None, None):
+            row = conn.execute('SELECT row_count FROM table_counts WHERE name = ?',
+                               ('devices',)).fetchone()
+            if row:
+                return row[0], True
+
+        cached = self._count_cache.get(count_key)
+        if cached is not None:
+            return cached
+
+        # stop counting past the limit, ui shows 'many' pages then
+        limit = self._count_limit + 1 if self._count_limit else -1
+        total = conn.execute(
+            f'''SELECT COUNT(*) FROM (
+                   SELECT 1 FROM devices d WHERE {where_sql} LIMIT ?
+               );''', params + [limit]).fetchone()[0]
+
+        result = (total, not self._count_limit or total <= self._count_limit)
+        self._count_cache.set(count_key, result)
+        return result
+
+    def __get_items(self, count_key, where_sql, params, query_params, sql):
+        with self._connect() as conn:
+            try:
+                total, total_exact = self.__count_devices(conn, count_key, where_sql, params)
+
+                cursor = conn.execute(sql, query_params)
+                items = [dict(row) for row in cursor.fetchall()]
+
+                return {
+                    'total': total,
+                    'total_exact': total_exact,
+                    'items': items
+                }
+
+            except sqlite3.Error as e:
+                print('search_devices failed:', e)
+                return {
+                    'total': 0,
+                    'total_exact': True,
+                    'items': []
+                }
+
+    def __page_result(self, result, page, after_id, before_id, keyset=True):
+        # one extra row was fetched to tell if there is more in paging direction
+        items = result['items']
+        has_more = len(items) > self._pagesize
+        items = items[:self._pagesize]
+
+        if before_id is not None:
+            items.reverse()
+            has_next, has_prev = True, has_more
+        else:
+            has_next, has_prev = has_more, after_id is not None or page > 1
+
+        return {
+            'total': result['total'],
+            'total_exact': result['total_exact'],
+            'items': items,
+            'has_next': has_next,
+            'has_prev': has_prev,
+            'next_after_id': items[-1]['id'] if keyset and items and has_next else None,
+            'prev_before_id': items[0]['id'] if keyset and items and has_prev else None
+        }
+
+    def search_devices(self, query=None, user_id=None, owned=False, page=1,
+                       after_id=None, before_id=None, ranked=False, free_between=None):
+        '''search device from db with page limit.
+
+        With after_id or before_id the page is sought by device id (keyset
+        paging) instead of skipping (page - 1) pages with OFFSET. Name and
+        description are matched through devices_fts, queries without any
+        word fall back to LIKE, ranked search orders matches by relevance
+        and pages with OFFSET.
+        free_between (starts_at, ends_at) timestamps leaves out devices that
+        are reserved at any moment of that time.
+        '''
+        match = fts_match_query(query) if query else None
+        ranked = ranked and match is not None
+        if ranked:
+            after_id, before_id = None, None
+
+        params = []
+        free_between = tuple(free_between) if free_between else None
+        clauses = self.__get_clauses(query, match, owned, user_id, params, free_between)
+        where_sql = ' AND '.join(clauses) or '1'
+        count_key = (query or '', bool(owned and user_id), user_id if owned else None,
+                     free_between)
+
+        rank_join = ''
+        rank_column = ''
+        rank_params = []
+        page_params = list(params)
+        page_order = 'd.id ASC'
+        order_sql = 'p.id ASC'
+        offset = 0
+        if ranked:
+            # name hits weigh more than description hits
+            rank_join = '''JOIN (
+                SELECT rowid AS device_id, bm25(devices_fts, 10.0, 1.0) AS rank
+                FROM devices_fts
+                WHERE devices_fts MATCH ?
+            ) AS fts ON d.id = fts.device_id'''
+            rank_column = ', fts.rank AS rank'
+            rank_params = [match]
+            page_params = []
+            clauses = self.__get_clauses(None, None, owned, user_id, page_params,
+                                         free_between)
+            page_order = 'fts.rank ASC, d.id ASC'
+            order_sql = 'p.rank ASC, p.id ASC'
+            offset = (page - 1) * self._pagesize
+        elif after_id is not None:
+            clauses.append('d.id > ?')
+            page_params.append(after_id)
+        elif before_id is not None:
+            clauses.append('d.id < ?')
+            page_params.append(before_id)
+            page_order = 'd.id DESC'
+            order_sql = 'p.id DESC'
+        else:
+            offset = (page - 1) * self._pagesize
+        page_where_sql = ' AND '.join(clauses) or '1'
+
+        # main query, pick ids of the page first and only then look up the
+        # reservation holding each one now and the next booking of user that
+        # has not started yet through idx_reservations_device_live
         sql = f'''
-        WITH RankedReservations AS (
-            SELECT
-                r.id, r.device_id, r.user_id, r.reserved_until,
-                u.username AS reserver_username,
-                ROW_NUMBER() OVER (PARTITION BY r.device_id ORDER BY r.reserved_until ASC) as rn
-            FROM reservations r
-            JOIN users u ON r.user_id = u.id
-            WHERE r.reserved_until > strftime('%s', 'now') AND r.ended_at IS NULL
+        WITH page AS (
+            SELECT d.id{rank_column}
+            FROM devices d
+            {rank_join}
+            WHERE {page_where_sql}
+            ORDER BY {page_order}
+            LIMIT ? OFFSET ?
         )
         SELECT
-            d.id, d.name, d.description, d.created_at,
+            d.id, d.name, d.description, d.created_at, d.version,
             u_creator.username AS creator_username,
-            COALESCE(rr_current_user.is_current_user_reservation, 0) AS current_user_has_reservation,
-            rr_any_user.id AS reservation_id,
-            rr_any_user.user_id AS reservation_user_id,
-            rr_any_user.reserved_until AS reservation_reserved_until,
-            rr_any_user.reserver_username AS reservation_username
-        FROM devices d
-        JOIN users u_creator ON d.created_by = u_creator.id
-        LEFT JOIN (
-            SELECT device_id, 1 AS is_current_user_reservation
-            FROM RankedReservations
-            WHERE user_id = ? AND rn = 1
-        ) AS rr_current_user ON d.id = rr_current_user.device_id
-        LEFT JOIN (
-            SELECT * FROM RankedReservations WHERE rn = 1
-        ) AS rr_any_user ON d.id = rr_any_user.device_id
-        WHERE {where_sql}
-        ORDER BY d.id ASC
-        LIMIT ? OFFSET ?;
+            CASE WHEN r.user_id = ? THEN 1 ELSE 0 END AS current_user_has_reservation,
+            r.id AS reservation_id,
+            r.user_id AS reservation_user_id,
+            r.reserved_until AS reservation_reserved_until,
+            u_reserver.username AS reservation_username,
+            r_next.id AS upcoming_id,
+            r_next.starts_at AS upcoming_starts_at,
+            r_next.reserved_until AS upcoming_reserved_until
+        FROM page p
+        JOIN devices d ON d.id = p.id
+        LEFT JOIN users u_creator ON d.created_by = u_creator.id
+        LEFT JOIN reservations r ON r.id = (
+            SELECT r_first.id
+            FROM reservations r_first
+            WHERE r_first.device_id = p.id
+            AND r_first.reserved_until > strftime('%s', 'now')
+            AND r_first.ended_at IS NULL
+            AND r_first.starts_at <= strftime('%s', 'now')
+            ORDER BY r_first.reserved_until ASC
+            LIMIT 1
+        )
+        LEFT JOIN users u_reserver ON r.user_id = u_reserver.id
+        LEFT JOIN reservations r_next ON r_next.id = (
+            SELECT r_mine.id
+            FROM reservations r_mine
+            WHERE r_mine.device_id = p.id
+            AND r_mine.user_id = ?
+            AND r_mine.reserved_until > strftime('%s', 'now')
+            AND r_mine.ended_at IS NULL
+            AND r_mine.starts_at > strftime('%s', 'now')
+            ORDER BY r_mine.starts_at ASC
+            LIMIT 1
+        )
+        ORDER BY {order_sql};
         '''
 
-        query_params = params + [user_id if user_id else 0,
-                                 self._pagesize,
-                                 (page - 1) * self._pagesize]
+        # parameters in the order they appear in sql text
+        query_params = (rank_params + page_params +
+                        [self._pagesize + 1, offset, user_id if user_id else 0,
+                         user_id if user_id else 0])
 
-        return self.__get_items(count_sql, params, query_params, sql)
+        result = self.__get_items(count_key, where_sql, params, query_params, sql)
+        return self.__page_result(result, page, after_id, before_id, keyset=not ranked)
 
     def get_all_devices(self, user_id=None, owned=False, page=1):
         '''get all devices from db'''
         return self.search_devices(query=None, user_id=user_id, owned=owned, page=page)
 
-    def create_reservation(self, user_id, device_id, reserved_until):
-        '''create reservation into db with device id'''
-        conn = self._connect()
-        try:
-            reserved_until = int(datetime.fromisoformat(reserved_until).timestamp())
-            conn.execute(
-                'INSERT INTO reservations (user_id, device_id, reserved_until) VALUES (?, ?, ?)',
-                (user_id, device_id, reserved_until)
-            )
-            conn.commit()
-            return True
-        except sqlite3.Error as e:
-            print('Error creating reservation:', e)
-            return False
-        finally:
-            conn.close()
-
-    def get_reservations_by_user(self, user_id):
-        '''get reservations made by user'''
-        conn = self._connect()
-        reservations = conn.execute(
+    def __get_active_reservation(self, conn, device_id):
+        return conn.execute(
             '''SELECT r.id, r.user_id, r.device_id, r.reserved_until,
-                    r.created_at, r.ended_at, d.name AS device_name
+                        r.created_at, r.ended_at, r.starts_at, u.username
                FROM reservations r
-               JOIN devices d ON r.device_id = d.id
                JOIN users u ON r.user_id = u.id
-               WHERE u.username = ? 
-               ORDER BY r.reserved_until DESC''',
-            (user_id,)
-        ).fetchall()
-        conn.close()
-        return reservations
-
-    def cancel_reservation(self, reservation_id):
-        '''cancel reservation for device with device id'''
-        conn = self._connect()
-        conn.execute(
-            '''UPDATE reservations 
-               SET ended_at = strftime('%s','now')
-               WHERE id = ?''',
-            (reservation_id,))
-        conn.commit()
-        conn.close()
+               WHERE r.device_id = ?
+               AND r.reserved_until > strftime('%s','now')
+               AND r.ended_at IS NULL
+               AND r.starts_at <= strftime('%s','now')
+               ORDER BY r.reserved_until
+               LIMIT 1''',
+            (device_id,)
+        ).fetchone()
 
-    def get_active_reservation_for_device(self, device_id):
-        '''get reservations for device with device id'''
-        conn = self._connect()
-        reservation = conn.execute(
+    def __get_overlapping_reservation(self, conn, device_id, starts_at, reserved_until):
+        # per device lookup goes through idx_reservations_device_live,
+        # r*tree can not narrow by device_id
+        return conn.execute(
             '''SELECT r.id, r.user_id, r.device_id, r.reserved_until,
-                        r.created_at, r.ended_at, u.username
+                        r.created_at, r.ended_at, r.starts_at, u.username
                FROM reservations r
                JOIN users u ON r.user_id = u.id
                WHERE r.device_id = ?
-               AND r.reserved_until > strftime('%s','now')
+               AND r.reserved_until > ?
                AND r.ended_at IS NULL
-               ORDER BY r.reserved_until
+               AND r.starts_at < ?
+               ORDER BY r.starts_at
                LIMIT 1''',
-            (device_id,)
+            (device_id, starts_at, reserved_until)
         ).fetchone()
-        conn.close()
-        return reservation
 
-    def get_active_reservations_by_user(self, username):
-        '''get active reservations by user'''
-        conn = self._connect()
-        cursor = conn.execute(
-            '''SELECT r.id, d.name, r.reserved_until
+    def get_overlapping_reservations(self, starts_at, ends_at, device_id=None):
+        '''reservations overlapping [starts_at, ends_at), found through the
+        reservation_intervals r*tree, ended ones included'''
+        params = []
+        sql = self.__overlap_sql(
+            params, starts_at, ends_at,
+            '''r_busy.id, r_busy.user_id, r_busy.device_id, r_busy.starts_at,
+               r_busy.reserved_until, r_busy.ended_at, r_busy.created_at''')
+        if device_id is not None:
+            sql += ' AND r_busy.device_id = ?'
+            params.append(device_id)
+        sql += ' ORDER BY r_busy.starts_at, r_busy.id'
+
+        with self._connect() as conn:
+            try:
+                return conn.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                print('get_overlapping_reservations failed:', e)
+                return []
+
+    def create_reservation(self, user_id, device_id, reserved_until, starts_at=None):
+        '''create reservation into db with device id.
+
+        Reservation starts now unless starts_at is given, so device can be
+        booked ahead of time. Returns (status, reservation) where status is
+        RESERVATION_CREATED, RESERVATION_CONFLICT with the reservation
+        overlapping the requested time or RESERVATION_FAILED. Overlap check
+        and insert run in the same write transaction, so two users can not
+        both get the device.
+        '''
+        def insert(conn):
+            conflict = self.__get_overlapping_reservation(
+                conn, device_id, starts_at_int, reserved_until_int)
+            if conflict:
+                return RESERVATION_CONFLICT, conflict
+            cursor = conn.execute(
+                '''INSERT INTO reservations (user_id, device_id, reserved_until, starts_at)
+                   VALUES (?, ?, ?, ?)''',
+                (user_id, device_id, reserved_until_int, starts_at_int)
+            )
+            self.__add_usage(conn, cursor.lastrowid)
+            return RESERVATION_CREATED, cursor.lastrowid
+
+        try:
+            reserved_until_int = int(datetime.fromisoformat(reserved_until).timestamp())
+            starts_at_int = int(time.time())
+            if starts_at:
+                starts_at_int = max(int(datetime.fromisoformat(starts_at).timestamp()),
+                                    starts_at_int)
+            if reserved_until_int <= starts_at_int:
+                raise ValueError('reservation ends before it starts')
+
+            # busy device is refused without queueing for the write lock
+            with self._connect() as conn:
+                conflict = self.__get_overlapping_reservation(
+                    conn, device_id, starts_at_int, reserved_until_int)
+            if conflict:
+                return RESERVATION_CONFLICT, conflict
+
+            status, result = self._write(insert)
+            if status == RESERVATION_CREATED:
+                self._count_cache.clear()
+                self.__notify('reservation_created', reservation_id=result,
+                              device_id=device_id, user_id=user_id,
+                              starts_at=starts_at_int, reserved_until=reserved_until_int)
+                return status, None
+            return status, result
+        except (sqlite3.Error, ValueError) as e:
+            print('Error creating reservation:', e)
+            return RESERVATION_FAILED, None
+
+    def get_reservation_by_id(self, reservation_id):
+        '''get reservation by id'''
+        with self._connect() as conn:
+            return conn.execute(
+                '''SELECT id, user_id, device_id, starts_at, reserved_until, created_at, ended_at
+                   FROM reservations
+                   WHERE id = ?''', (reservation_id,)).fetchone()
+
+    def get_reservations_by_user(self, user_id):
+        '''get reservations made by user'''
+        with self._connect() as conn:
+            return conn.execute(
+                '''SELECT r.id, r.user_id, r.device_id, r.reserved_until,
+                        r.created_at, r.ended_at, d.name AS device_name
+                   FROM reservations r
+                   JOIN devices d ON r.device_id = d.id
+                   WHERE r.user_id = ?
+                   ORDER BY r.reserved_until DESC''',
+                (user_id,)
+            ).fetchall()
+
+    def __bump_usage_version(self, conn, reservation_id):
+        # rollup rows of the reservation's user changed, their charts are stale
+        conn.execute(
+            '''UPDATE users SET usage_version = usage_version + 1
+               WHERE id = (SELECT user_id FROM reservations WHERE id = ?)''',
+            (reservation_id,))
+
+    def __add_usage(self, conn, reservation_id):
+        # new reservation into user_device_usage rollup, same transaction as insert
+        self.__bump_usage_version(conn, reservation_id)
+        conn.execute(
+            '''INSERT INTO user_device_usage
+                   (user_id, device_id, reservation_count, total_seconds)
+               SELECT user_id, device_id, 1, MAX(reserved_until - starts_at, 0)
+               FROM reservations
+               WHERE id = ?
+               ON CONFLICT (user_id, device_id) DO UPDATE SET
+                   reservation_count = reservation_count + excluded.reservation_count,
+                   total_seconds = total_seconds + excluded.total_seconds''',
+            (reservation_id,))
+
+    def __end_usage(self, conn, reservation_id, ended_at):
+        # reservation now runs until ended_at instead of reserved_until
+        self.__bump_usage_version(conn, reservation_id)
+        conn.execute(
+            '''UPDATE user_device_usage
+               SET total_seconds = total_seconds + (
+                   SELECT MAX(? - r.starts_at, 0) - MAX(r.reserved_until - r.starts_at, 0)
+                   FROM reservations r
+                   WHERE r.id = ?)
+               WHERE (user_id, device_id) = (
+                   SELECT user_id, device_id
+                   FROM reservations
+                   WHERE id = ? AND ended_at IS NULL)''',
+            (ended_at, reservation_id, reservation_id))
+
+    def cancel_reservation(self, reservation_id):
+        '''cancel reservation for device with device id'''
+        def release(conn):
+            ended_at = int(time.time())
+            self.__end_usage(conn, reservation_id, ended_at)
+            return conn.execute(
+                '''UPDATE reservations
+                   SET ended_at = ?
+                   WHERE id = ? AND ended_at IS NULL
+                   RETURNING device_id, user_id''',
+                (ended_at, reservation_id)).fetchall()
+
+        released = self._write(release)
+        self._count_cache.clear()
+        if released:
+            self.__notify('reservation_released', reservation_id=reservation_id,
+                          device_id=released[0]['device_id'], user_id=released[0]['user_id'])
+
+    def end_expired_reservations(self, batch_size=500):
+        '''stamp ended_at = reserved_until on at most batch_size expired
+        reservations, returns how many were ended.
+
+        Expired reservations run until reserved_until, so the usage rollup
+        does not change. Each batch is its own short write transaction.
+        '''
+        def expire(conn):
+            return conn.execute(
+                '''UPDATE reservations
+                   SET ended_at = reserved_until
+                   WHERE id IN (
+                       SELECT id FROM reservations
+                       WHERE ended_at IS NULL
+                       AND reserved_until <= strftime('%s', 'now')
+                       ORDER BY reserved_until
+                       LIMIT ?)''',
+                (batch_size,)).rowcount
+
+        try:
+            return self._write(expire)
+        except sqlite3.Error as e:
+            print('end_expired_reservations failed:', e)
+            return 0
+
+    def get_active_reservation_for_device(self, device_id):
+        '''get reservations for device with device id'''
+        with self._connect() as conn:
+            return self.__get_active_reservation(conn, device_id)
+
+    def __get_active_reservations_by_user(self, conn, user_id):
+        return conn.execute(
+            '''SELECT r.id, d.name, r.reserved_until,
+                   CASE
+                       WHEN r.starts_at > strftime('%s', 'now') THEN r.starts_at
+                   END AS upcoming_start
                FROM reservations r
                JOIN devices d ON r.device_id = d.id
-               JOIN users u ON r.user_id = u.id
-               WHERE u.username = ? AND r.reserved_until > strftime('%s', 'now')
-               AND ended_at IS NULL''',
-            (username,))
-        results = cursor.fetchall()
-        conn.close()
-        return results
-
-    def get_devices_created_by_user(self, username):
-        '''get devices created by user'''
-        conn = self._connect()
-        cursor = conn.execute(
+               WHERE r.user_id = ? AND r.reserved_until > strftime('%s', 'now')
+               AND r.ended_at IS NULL
+               -- unary + keeps the planner on idx_reservations_user_live
+               -- instead of walking idx_reservations_starts for the order
+               ORDER BY +r.starts_at''',
+            (user_id,)).fetchall()
+
+    def __get_devices_created_by_user(self, conn, user_id):
+        return conn.execute(
             '''SELECT d.id, d.name, d.description
                FROM devices d
-               JOIN users u ON d.created_by = u.id
-               WHERE u.username = ?''',
-            (username,))
-        results = cursor.fetchall()
-        conn.close()
-        return results
-
-    def get_last_reservations_by_user(self, username, limit=10):
-        '''get last reservations by user'''
-        conn = self._connect()
-        cursor = conn.execute(
-            '''SELECT r.id, d.name, 
-                   CASE 
-                       WHEN r.ended_at IS NOT NULL THEN r.ended_at 
-                       ELSE r.reserved_until 
+               WHERE d.created_by = ?''',
+            (user_id,)).fetchall()
+
+    def __get_last_reservations_by_user(self, conn, user_id, limit):
+        return conn.execute(
+            '''SELECT r.id, d.name,
+                   CASE
+                       WHEN r.ended_at IS NOT NULL THEN r.ended_at
+                       ELSE r.reserved_until
                    END AS effective_end,
                    r.created_at
                FROM reservations r
                LEFT JOIN devices d ON r.device_id = d.id
-               JOIN users u ON r.user_id = u.id
-               WHERE u.username = ?
+               WHERE r.user_id = ?
                ORDER BY r.created_at DESC
                LIMIT ?''',
-            (username, limit))
-        results = cursor.fetchall()
-        conn.close()
-        return results
+            (user_id, limit)).fetchall()
+
+    def get_active_reservations_by_user(self, user_id):
+        '''get active reservations by user'''
+        with self._connect() as conn:
+            return self.__get_active_reservations_by_user(conn, user_id)
+
+    def get_devices_created_by_user(self, user_id):
+        '''get devices created by user'''
+        with self._connect() as conn:
+            return self.__get_devices_created_by_user(conn, user_id)
+
+    def get_last_reservations_by_user(self, user_id, limit=10):
+        '''get last reservations by user'''
+        with self._connect() as conn:
+            return self.__get_last_reservations_by_user(conn, user_id, limit)
+
+    def __get_charts_version(self, conn, user_id):
+        # usage rollup of user and device names, None if not tracked
+        try:
+            row = conn.execute(
+                '''SELECT u.usage_version, tv.version
+                   FROM users u
+                   JOIN table_versions tv ON tv.name = 'devices'
+                   WHERE u.id = ?''', (user_id,)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return tuple(row) if row else None
+
+    def get_user_dashboard(self, user_id, last_limit=10):
+        '''everything user page shows, read from one snapshot of the db.
+        Usage statistics are not read, charts_version tells when what
+        get_user_device_reservations() returns has changed'''
+        with self._connect() as conn:
+            conn.execute('BEGIN')
+            try:
+                return {
+                    'reservations': self.__get_active_reservations_by_user(conn, user_id),
+                    'devices': self.__get_devices_created_by_user(conn, user_id),
+                    'last_reservations': self.__get_last_reservations_by_user(
+                        conn, user_id, last_limit),
+                    'charts_version': self.__get_charts_version(conn, user_id)
+                }
+            finally:
+                conn.commit()
 
     def add_comment(self, device_id, user_id, content):
         '''add comment to device'''
-        conn = self._connect()
         try:
-            conn.execute(
+            comment_id = self._write(lambda conn: conn.execute(
                 'INSERT INTO comments (device_id, user_id, content) VALUES (?, ?, ?)',
-                (device_id, user_id, content)
-            )
-            conn.commit()
+                (device_id, user_id, content)).lastrowid)
+            self.__notify('comment_added', device_id=device_id, comment_id=comment_id,
+                          user_id=user_id)
             return True
         except sqlite3.Error as e:
             print(f'Error adding comment: {e}')
             return False
-        finally:
-            conn.close()
 
     def get_comments_for_device(self, device_id):
         '''get comments for device'''
-        conn = self._connect()
-        try:
-            cursor = conn.cursor()
-            cursor.execute(
+        with self._connect() as conn:
+            cursor = conn.execute(
                 '''SELECT c.id, c.content, c.created_at, u.username AS author_username, c.user_id
                    FROM comments c
                    JOIN users u ON c.user_id = u.id
@@ -316,25 +904,59 @@ class Database:
                    ORDER BY c.created_at DESC''',
                 (device_id,))
             return [dict(row) for row in cursor.fetchall()]
-        finally:
-            conn.close()
+
+    def get_comment_page(self, device_id, before=None, limit=20):
+        '''newest comments of device older than before (created_at, id).
+
+        Pages are sought through idx_comments_device_created_at, so any page
+        costs the same however many comments the device has. Returns items,
+        has_more and next_before to pass as before for the following page.
+        '''
+        params = [device_id]
+        before_sql = ''
+        if before is not None:
+            before_sql = 'AND (c.created_at, c.id) < (?, ?)'
+            params.extend(before)
+        params.append(limit + 1)
+
+        with self._connect() as conn:
+            try:
+                cursor = conn.execute(
+                    f'''SELECT c.id, c.content, c.created_at,
+                              u.username AS author_username, c.user_id
+                       FROM comments c
+                       JOIN users u ON c.user_id = u.id
+                       WHERE c.device_id = ? {before_sql}
+                       ORDER BY c.created_at DESC, c.id DESC
+                       LIMIT ?''',
+                    params)
+                items = [dict(row) for row in cursor.fetchall()]
+            except sqlite3.Error as e:
+                print('get_comment_page failed:', e)
+                items = []
+
+        has_more = len(items) > limit
+        items = items[:limit]
+        return {
+            'items': items,
+            'has_more': has_more,
+            'next_before': (items[-1]['created_at'], items[-1]['id']) if has_more else None
+        }
 
     def get_comment_by_id(self, comment_id):
         '''get comment by id'''
-        conn = self._connect()
-        comment = conn.execute(
-            '''SELECT id, device_id, user_id, content, created_at
-               FROM comments
-               WHERE id = ?''', (comment_id,)).fetchone()
-        conn.close()
-        return comment
+        with self._connect() as conn:
+            return conn.execute(
+                '''SELECT id, device_id, user_id, content, created_at
+                   FROM comments
+                   WHERE id = ?''', (comment_id,)).fetchone()
 
     def delete_comment(self, comment_id, user_id_who_is_deleting):
         '''delete comment'''
-        conn = self._connect()
-        try:
+        def delete(conn):
             # check if user deleting is the author
-            comment = self.get_comment_by_id(comment_id)
+            comment = conn.execute('SELECT user_id FROM comments WHERE id = ?',
+                                   (comment_id,)).fetchone()
             if not comment:
                 print('Comment not found for deletion.')
                 return False
@@ -343,83 +965,43 @@ class Database:
                 return False
 
             conn.execute('DELETE FROM comments WHERE id = ?', (comment_id,))
-            conn.commit()
             return True
+
+        try:
+            return self._write(delete)
         except sqlite3.Error as e:
             print(f'Error deleting comment: {e}')
             return False
-        finally:
-            conn.close()
 
-    def __get_user_device_reservation_durations(self, user_id):
-        conn = self._connect()
+    def __get_user_device_reservation_stats(self, conn, user_id):
+        # count and total duration per device from user_device_usage rollup,
+        # one row per device the user has ever reserved
         try:
-            cursor = conn.cursor()
-            cursor.execute(
+            cursor = conn.execute(
                 '''SELECT
-                        d.id as device_id,
-                        d.name as device_name,
-                   SUM(
-                        CASE
-                            WHEN r.ended_at IS NOT NULL AND r.ended_at > r.created_at
-                                THEN r.ended_at - r.created_at
-                            WHEN r.ended_at IS NULL AND r.reserved_until > r.created_at
-                                THEN r.reserved_until - r.created_at
-                            ELSE 0
-                        END
-                   ) as total_duration_seconds
+                        d.id AS device_id,
+                        d.name AS device_name,
+                        u.reservation_count,
+                        u.total_seconds AS total_duration_seconds
                    FROM
-                        devices d
+                        user_device_usage u
                    JOIN
-                        reservations r ON d.id = r.device_id
+                        devices d ON d.id = u.device_id
                    WHERE
-                        r.user_id = ?
-                   GROUP BY
-                        d.id, d.name
-                   HAVING
-                        SUM(CASE
-                            WHEN r.ended_at IS NOT NULL AND r.ended_at > r.created_at
-                            THEN r.ended_at - r.created_at
-                            WHEN r.ended_at IS NULL AND r.reserved_until > r.created_at
-                            THEN r.reserved_until - r.created_at ELSE 0 END) > 0
+                        u.user_id = ? AND u.reservation_count > 0
                    ORDER BY
-                        total_duration_seconds DESC''', (user_id,))
-            return [dict(row) for row in cursor.fetchall()]
+                        u.reservation_count DESC''', (user_id,))
+            rows = [dict(row) for row in cursor.fetchall()]
         except sqlite3.Error as e:
-            print(f'Error in get_user_device_reservation_durations: {e}')
-            return []
-        finally:
-            conn.close()
+            print(f'Error in get_user_device_reservation_stats: {e}')
+            return [], []
 
-    def __get_user_device_reservation_counts(self, user_id):
-        conn = self._connect()
-        try:
-            cursor = conn.cursor()
-            cursor.execute(
-                '''SELECT
-                    d.id as device_id,
-                    d.name as device_name,
-                   COUNT(r.id) as reservation_count
-                   FROM
-                        devices d
-                   JOIN
-                        reservations r ON d.id = r.device_id
-                   WHERE
-                        r.user_id = ?
-                   GROUP BY
-                        d.id, d.name
-                   HAVING
-                        COUNT(r.id) > 0 -- #drop devices with no reservations
-                ORDER BY
-                    reservation_count DESC''', (user_id,))
-            return [dict(row) for row in cursor.fetchall()]
-        except sqlite3.Error as e:
-            print(f'Error in get_user_device_reservation_counts: {e}')
-            return []
-        finally:
-            conn.close()
+        durations = sorted((row for row in rows if row['total_duration_seconds'] > 0),
+                           key=lambda row: row['total_duration_seconds'],
+                           reverse=True)
+        return rows, durations
 
     def get_user_device_reservations(self, user_id):
         '''user created device reservations tuple with count and time'''
-        return (self.__get_user_device_reservation_counts(user_id),
-                self.__get_user_device_reservation_durations(user_id))
+        with self._connect() as conn:
+            return self.__get_user_device_reservation_stats(conn, user_id)
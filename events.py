@@ -0,0 +1,79 @@
+'''in-process change feed for slotkeeper'''
+import asyncio
+import threading
+import time
+from collections import deque
+
+def wake(future):
+    '''resolve future of a waiting task, unless it timed out already'''
+    if not future.done():
+        future.set_result(None)
+
+class EventBus:
+    '''Thread safe ring buffer of the latest change events.
+
+    Writers publish, any number of watchers wait for events newer than the
+    last sequence number they saw. All watchers share the same buffer, so
+    a change costs one append however many clients follow it. The feed is
+    per process, with several worker processes each one sees its own writes.
+    Threads wait with wait(), asyncio tasks with wait_async() without
+    holding a thread.
+    '''
+    def __init__(self, capacity=1000):
+        self._events = deque(maxlen=capacity)
+        self._seq = 0
+        self._cond = threading.Condition()
+        # futures of tasks in wait_async(): their event loops
+        self._futures = {}
+
+    def publish(self, kind, **data):
+        '''append event and wake up waiting watchers, returns its sequence number'''
+        with self._cond:
+            self._seq += 1
+            self._events.append({'id': self._seq, 'type': kind, 'time': int(time.time()),
+                                 'data': data})
+            self._cond.notify_all()
+            seq = self._seq
+            futures, self._futures = self._futures, {}
+        for future, loop in futures.items():
+            loop.call_soon_threadsafe(wake, future)
+        return seq
+
+    def last_id(self):
+        '''sequence number of the latest event, 0 before any'''
+        with self._cond:
+            return self._seq
+
+    def __since(self, after_id):
+        if self._events and self._events[0]['id'] > after_id + 1:
+            # watcher fell behind the ring buffer, it has to reload everything
+            return [{'id': self._seq, 'type': 'reset', 'time': int(time.time()), 'data': {}}]
+        return [event for event in self._events if event['id'] > after_id]
+
+    def wait(self, after_id, timeout):
+        '''events newer than after_id, waits up to timeout seconds for one'''
+        with self._cond:
+            if after_id > self._seq:
+                after_id = 0  # sequence from before a restart
+            self._cond.wait_for(lambda: self._seq > after_id, timeout)
+            return self.__since(after_id)
+
+    async def wait_async(self, after_id, timeout):
+        '''wait() for asyncio tasks'''
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if after_id > self._seq:
+                after_id = 0
+            if self._seq > after_id:
+                return self.__since(after_id)
+            future = loop.create_future()
+            self._futures[future] = loop
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._futures.pop(future, None)
+        with self._cond:
+            return self.__since(after_id)
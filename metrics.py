@@ -0,0 +1,214 @@
+'''Prometheus text exposition of slotkeeper request metrics'''
+import bisect
+import threading
+import weakref
+
+# request latency histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape_label(value):
+    '''label value escaped for the text format'''
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labels):
+    '''{name="value",...} or empty without labels'''
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items())
+    return '{' + pairs + '}'
+
+def format_value(value):
+    '''sample value, +Inf for infinity'''
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Shard:
+    '''request counters written by one thread only'''
+    def __init__(self, n_buckets):
+        self.n_buckets = n_buckets
+        # (endpoint, method): [count per bucket and +Inf..., count, seconds,
+        # statements, db seconds]
+        self.requests = {}
+        # (endpoint, method, status): count
+        self.statuses = {}
+
+    def new_values(self):
+        '''zeroed counters of one route'''
+        return [0] * (self.n_buckets + 1) + [0, 0.0, 0, 0.0]
+
+    def merge(self, other):
+        '''add counters of other shard'''
+        for key, values in list(other.requests.items()):
+            mine = self.requests.get(key)
+            if mine is None:
+                mine = self.requests[key] = self.new_values()
+            for i, value in enumerate(values):
+                mine[i] += value
+        for key, count in list(other.statuses.items()):
+            self.statuses[key] = self.statuses.get(key, 0) + count
+
+class ShardHolder:
+    '''thread local owner of a shard, collected when its thread ends'''
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+class Metrics:
+    '''Request metrics sharded per thread, plus collectors read on scrape.
+
+    Every request thread counts into its own shard without locking, the
+    lock is only taken when a thread first records, when its shard is
+    folded into the totals as the thread ends, and on scrape. Collectors
+    are callables returning (name, type, help, [(labels, value)]) tuples
+    for gauges and counters kept elsewhere, e.g. pool and cache stats.
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = set()
+        self._retired = Shard(len(self.buckets))
+        self._collectors = []
+
+    def add_collector(self, collector):
+        '''call collector() on every scrape for more metric families'''
+        self._collectors.append(collector)
+
+    def __shard(self):
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            # holder lives as long as the thread, its shard outlives it in totals
+            holder = self._local.holder = ShardHolder(Shard(len(self.buckets)))
+            with self._lock:
+                self._shards.add(holder.shard)
+            weakref.finalize(holder, self.__retire, holder.shard)
+        return holder.shard
+
+    def __retire(self, shard):
+        with self._lock:
+            self._shards.discard(shard)
+            self._retired.merge(shard)
+
+    def observe(self, endpoint, method, status, seconds, statements=0, db_seconds=0.0):
+        '''count request to endpoint that took seconds and ran statements'''
+        shard = self.__shard()
+        values = shard.requests.get((endpoint, method))
+        if values is None:
+            values = shard.requests[(endpoint, method)] = shard.new_values()
+        values[bisect.bisect_left(self.buckets, seconds)] += 1
+        values[-4] += 1
+        values[-3] += seconds
+        values[-2] += statements
+        values[-1] += db_seconds
+        key = (endpoint, method, status)
+        shard.statuses[key] = shard.statuses.get(key, 0) + 1
+
+    def __totals(self):
+        totals = Shard(len(self.buckets))
+        with self._lock:
+            totals.merge(self._retired)
+            for shard in list(self._shards):
+                totals.merge(shard)
+        return totals
+
+    def __request_families(self):
+        totals = self.__totals()
+        latency, statements, db_time, statuses = [], [], [], []
+        for (endpoint, method), values in sorted(totals.requests.items()):
+            labels = {'endpoint': endpoint, 'method': method}
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                latency.append(('_bucket', dict(labels, le=format_value(float(bound))),
+                                cumulative))
+            latency.append(('_sum', labels, values[-3]))
+            latency.append(('_count', labels, values[-4]))
+            statements.append(('', labels, values[-2]))
+            db_time.append(('', labels, values[-1]))
+        for (endpoint, method, status), count in sorted(totals.statuses.items()):
+            statuses.append(('', {'endpoint': endpoint, 'method': method,
+                                  'status': status}, count))
+        return [
+            ('slotkeeper_request_duration_seconds', 'histogram',
+             'Request latency by route', latency),
+            ('slotkeeper_requests_total', 'counter',
+             'Requests by route and response status', statuses),
+            ('slotkeeper_request_db_statements_total', 'counter',
+             'SQL statements run by requests of route', statements),
+            ('slotkeeper_request_db_seconds_total', 'counter',
+             'Time in SQL statements of requests of route', db_time),
+        ]
+
+    def render(self):
+        '''all metrics in Prometheus text exposition format'''
+        lines = []
+        for name, kind, help_text, samples in self.__request_families():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                lines.append(f'{name}{suffix}{format_labels(labels)} {format_value(value)}')
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:  # a broken collector must not fail the scrape
+                print('Metrics collector failed:', e)
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+POOL_EVENTS = {
+    'created': 'Database connections opened by the pool',
+    'reused': 'Idle pooled connections handed out again',
+    'waited': 'Acquires that had to wait for a free connection',
+    'timeouts': 'Acquires that gave up waiting for a connection',
+    'discarded': 'Broken pooled connections closed'
+}
+
+def pool_families(stats):
+    '''metric families of ConnectionPool.stats()'''
+    return [
+        ('slotkeeper_db_pool_connections', 'gauge', 'Pooled database connections by state',
+         [({'state': 'open'}, stats['size']), ({'state': 'idle'}, stats['idle']),
+          ({'state': 'in_use'}, stats['in_use'])]),
+        ('slotkeeper_db_pool_max_connections', 'gauge', 'Pool size limit',
+         [({}, stats['max_size'])]),
+        ('slotkeeper_db_pool_peak_in_use', 'gauge', 'Most connections in use at once',
+         [({}, stats['peak_in_use'])]),
+    ] + [
+        (f'slotkeeper_db_pool_{event}_total', 'counter', help_text, [({}, stats[event])])
+        for event, help_text in POOL_EVENTS.items()
+    ]
+
+def cache_families(caches):
+    '''metric families of {cache name: stats()} with hits, misses and size'''
+    hits, misses, ratios, sizes = [], [], [], []
+    for name, stats in sorted(caches.items()):
+        labels = {'cache': name}
+        lookups = stats['hits'] + stats['misses']
+        hits.append((labels, stats['hits']))
+        misses.append((labels, stats['misses']))
+        ratios.append((labels, stats['hits'] / lookups if lookups else 0.0))
+        sizes.append((labels, stats['size']))
+    return [
+        ('slotkeeper_cache_hits_total', 'counter', 'Cache hits', hits),
+        ('slotkeeper_cache_misses_total', 'counter', 'Cache misses', misses),
+        ('slotkeeper_cache_hit_ratio', 'gauge', 'Cache hits per lookup since start', ratios),
+        ('slotkeeper_cache_entries', 'gauge', 'Cached entries', sizes),
+    ]
+
+def query_families(totals):
+    '''metric families of QueryStats.totals()'''
+    return [
+        ('slotkeeper_db_statements_total', 'counter', 'SQL statements run',
+         [({}, totals['statements'])]),
+        ('slotkeeper_db_statement_seconds_total', 'counter', 'Time in SQL statements',
+         [({}, totals['seconds'])]),
+        ('slotkeeper_db_slow_statements_total', 'counter',
+         'SQL statements over the slow query threshold', [({}, totals['slow'])]),
+    ]
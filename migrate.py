@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''bring existing slotkeeper database up to date with schema.sql'''
+import argparse
+import sqlite3
+
+DB_PATH = 'database.db'
+SCHEMA_PATH = 'schema.sql'
+
+# columns added to existing tables after their first release. ALTER TABLE
+# cannot use the expression defaults from schema.sql, so existing rows get
+# starts_at from the reservation_starts_at migration and later inserts
+# leaving it out from the trg_reservations_starts_at trigger
+ADDED_COLUMNS = [
+    ('reservations', 'starts_at', 'INTEGER'),
+    ('devices', 'version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('users', 'usage_version', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+# indexes and triggers replaced by differently defined ones in schema.sql
+DROPPED = [
+    ('index', 'idx_reservations_device_active'),
+    ('index', 'idx_reservations_user_active'),
+    ('trigger', 'trg_reservation_intervals_insert'),
+]
+
+def drop_replaced(conn):
+    '''drop indexes and triggers schema.sql no longer creates'''
+    for kind, name in DROPPED:
+        if conn.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?',
+                        (kind, name)).fetchone():
+            print(f'Dropping {name}...')
+            conn.execute(f'DROP {kind.upper()} {name}')
+
+def add_columns(conn):
+    '''add columns missing from tables created by an older schema.sql'''
+    for table, column, column_type in ADDED_COLUMNS:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+        if columns and column not in columns:
+            print(f'Adding {table}.{column}...')
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+def apply_schema(conn):
+    '''create missing tables, indexes and triggers, schema.sql is idempotent'''
+    add_columns(conn)
+    with open(SCHEMA_PATH, encoding='utf-8') as f:
+        conn.executescript(f.read())
+    drop_replaced(conn)
+
+def backfill_table_counts(conn):
+    '''set trigger maintained row counters from current table contents'''
+    conn.execute(
+        '''INSERT OR REPLACE INTO table_counts (name, row_count)
+           SELECT 'devices', COUNT(*) FROM devices''')
+
+def rebuild_devices_fts(conn):
+    '''index all existing devices into devices_fts'''
+    conn.execute('''INSERT INTO devices_fts (devices_fts) VALUES ('rebuild')''')
+
+def backfill_reservation_starts_at(conn):
+    '''reservations made before future bookings start when they were created'''
+    conn.execute('UPDATE reservations SET starts_at = created_at WHERE starts_at IS NULL')
+
+def rebuild_reservation_intervals(conn):
+    '''index all existing reservations into reservation_intervals'''
+    conn.execute('DELETE FROM reservation_intervals')
+    conn.execute(
+        '''INSERT INTO reservation_intervals (id, starts_at, ends_at, device_id)
+           SELECT id, starts_at,
+                  MAX(starts_at, COALESCE(ended_at, reserved_until)), device_id
+           FROM reservations''')
+
+def rebuild_user_device_usage(conn):
+    '''recompute user_device_usage rollup from all reservations'''
+    conn.execute('DELETE FROM user_device_usage')
+    conn.execute(
+        '''INSERT INTO user_device_usage
+               (user_id, device_id, reservation_count, total_seconds)
+           SELECT user_id, device_id, COUNT(*),
+                  SUM(MAX(COALESCE(ended_at, reserved_until) - starts_at, 0))
+           FROM reservations
+           GROUP BY user_id, device_id''')
+    conn.execute('UPDATE users SET usage_version = usage_version + 1')
+
+# data migrations, each one is run once per database
+MIGRATIONS = [
+    ('table_counts', backfill_table_counts),
+    ('devices_fts', rebuild_devices_fts),
+    ('reservation_starts_at', backfill_reservation_starts_at),
+    ('user_device_usage', rebuild_user_device_usage),
+    ('reservation_intervals', rebuild_reservation_intervals),
+]
+
+def migrate(conn, rebuild=()):
+    '''apply schema and pending data migrations, names in rebuild are run again'''
+    apply_schema(conn)
+    conn.execute(
+        '''CREATE TABLE IF NOT EXISTS schema_migrations (
+               name TEXT PRIMARY KEY,
+               applied_at INTEGER DEFAULT (strftime('%s','now'))
+           )''')
+    applied = {row[0] for row in conn.execute('SELECT name FROM schema_migrations')}
+
+    for name, migration in MIGRATIONS:
+        if name in applied and name not in rebuild:
+            continue
+        print(f'Applying {name}...')
+        with conn:
+            migration(conn)
+            conn.execute('INSERT OR REPLACE INTO schema_migrations (name) VALUES (?)', (name,))
+
+def main():
+    '''main'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db_path', nargs='?', default=DB_PATH)
+    parser.add_argument('--rebuild', nargs='+', default=[],
+                        choices=[name for name, _ in MIGRATIONS],
+                        help='run these data migrations again, e.g. user_device_usage')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db_path)
+    try:
+        migrate(conn, args.rebuild)
+    finally:
+        conn.close()
+    print('Database is up to date.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+'''SQL statement timing for slotkeeper'''
+import contextvars
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('slotkeeper.sql')
+
+STRING_LITERAL = re.compile(r'\'(?:[^\']|\'\')*\'')
+NUMBER_LITERAL = re.compile(r'(?<![\w.?])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b')
+VALUE_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+# statements without a query plan
+NOT_EXPLAINED = ('BEGIN', 'COMMIT', 'END', 'ROLLBACK', 'SAVEPOINT', 'RELEASE', 'PRAGMA')
+OTHER_STATEMENTS = '(other statements)'
+
+def normalize_sql(sql):
+    '''sql with literal values replaced by ? and whitespace collapsed, so runs
+    of the same statement with different values aggregate together'''
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = VALUE_LIST.sub('IN (?, ...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+class RequestQueries:
+    '''statements run for one request'''
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+class ConnectionTrace:
+    '''statement trace of one pooled connection, called with sql and
+    parameters before each statement'''
+    def __init__(self, stats):
+        self._stats = stats
+        self.sql = None
+        self.parameters = ()
+        self.start = 0.0
+        self.slow = []
+
+    def __call__(self, sql, parameters):
+        # query plans of slow statements are our own
+        if sql.startswith('EXPLAIN'):
+            return
+        now = time.perf_counter()
+        if self.sql is not None:
+            self._stats.record(self, now - self.start)
+        self.sql, self.parameters, self.start = sql, parameters, now
+
+    def finish(self, conn):
+        '''close timing of the last statement, explain slow ones'''
+        if self.sql is not None:
+            self._stats.record(self, time.perf_counter() - self.start)
+            self.sql = None
+        if self.slow:
+            slow, self.slow = self.slow, []
+            for sql, parameters, seconds in slow:
+                self._stats.log_slow(conn, sql, parameters, seconds)
+
+class QueryStats:
+    '''Times every SQL statement run on traced connections.
+
+    A statement is timed from its start to the start of the next one on the
+    same connection or the connection going back to the pool, so fetching
+    its rows is included. Statements are aggregated by normalized text,
+    counted for the current request and logged when slower than
+    slow_threshold seconds, with EXPLAIN QUERY PLAN at most once per
+    explain_interval for the same statement. Statements are seen as
+    written, with ? placeholders, so normalizing is memoized per text and
+    the cost is a dict lookup and a short locked update per statement.
+    '''
+    def __init__(self, slow_threshold=0.1, explain_interval=60.0, max_statements=500):
+        self.slow_threshold = slow_threshold
+        self._explain_interval = explain_interval
+        self._max_statements = max_statements
+        self._lock = threading.Lock()
+        # normalized sql: [count, seconds, max seconds]
+        self._statements = {}
+        self._count = 0
+        self._seconds = 0.0
+        self._slow = 0
+        self._explained = {}
+        self._normalized = {}
+        self._request = contextvars.ContextVar('slotkeeper_sql_request', default=None)
+
+    def trace(self, conn):
+        '''trace of conn taken from the pool, set up on first use. conn calls
+        its sql_trace before each statement, see database.PooledConnection'''
+        trace = conn.sql_trace
+        if trace is None:
+            trace = conn.sql_trace = ConnectionTrace(self)
+        # pool health checks and rollbacks are not part of the caller's work
+        trace.sql = None
+        return trace
+
+    def begin_request(self):
+        '''count statements of the current request into returned counters'''
+        queries = RequestQueries()
+        self._request.set(queries)
+        return queries
+
+    def end_request(self):
+        '''stop counting for the current request'''
+        self._request.set(None)
+
+    def __normalize(self, sql):
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            normalized = normalize_sql(sql)
+            if len(self._normalized) >= self._max_statements * 4:
+                # statements with values written in, do not keep them all
+                self._normalized.clear()
+            self._normalized[sql] = normalized
+        return normalized
+
+    def record(self, trace, seconds):
+        '''account statement of trace that took seconds'''
+        queries = self._request.get()
+        if queries is not None:
+            queries.count += 1
+            queries.seconds += seconds
+        normalized = self.__normalize(trace.sql)
+        slow = seconds >= self.slow_threshold
+        with self._lock:
+            self._count += 1
+            self._seconds += seconds
+            entry = self._statements.get(normalized)
+            if entry is None:
+                key = normalized
+                if len(self._statements) >= self._max_statements:
+                    key = OTHER_STATEMENTS
+                entry = self._statements.setdefault(key, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            if slow:
+                self._slow += 1
+        if slow:
+            trace.slow.append((trace.sql, trace.parameters, seconds))
+
+    def __explain_due(self, normalized):
+        now = time.monotonic()
+        with self._lock:
+            last = self._explained.get(normalized)
+            if last is not None and now - last < self._explain_interval:
+                return False
+            if len(self._explained) >= self._max_statements:
+                self._explained.clear()
+            self._explained[normalized] = now
+            return True
+
+    def log_slow(self, conn, sql, parameters, seconds):
+        '''log slow statement, with its query plan when one is due'''
+        normalized = self.__normalize(sql)
+        plan = []
+        if not normalized.upper().startswith(NOT_EXPLAINED) and self.__explain_due(normalized):
+            try:
+                plan = [row[3] for row in
+                        conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+            except sqlite3.Error as e:
+                plan = [f'no plan: {e}']
+        logger.warning('slow query %.1f ms: %s%s', seconds * 1000, normalized,
+                       ''.join('\n    ' + line for line in plan))
+
+    def totals(self):
+        '''statements, their seconds and slow ones since start'''
+        with self._lock:
+            return {'statements': self._count, 'seconds': self._seconds, 'slow': self._slow}
+
+    def snapshot(self, limit=20):
+        '''totals and the statements with most total time'''
+        with self._lock:
+            statements = [(sql, *entry) for sql, entry in self._statements.items()]
+            totals = {
+                'statements': self._count,
+                'total_ms': round(self._seconds * 1000, 3),
+                'slow': self._slow,
+                'slow_threshold_ms': self.slow_threshold * 1000,
+                'distinct': len(self._statements)
+            }
+        statements.sort(key=lambda s: s[2], reverse=True)
+        totals['top'] = [
+            {'sql': sql, 'count': count,
+             'total_ms': round(seconds * 1000, 3),
+             'mean_ms': round(seconds / count * 1000, 3),
+             'max_ms': round(max_seconds * 1000, 3)}
+            for sql, count, seconds, max_seconds in statements[:limit]]
+        return totals
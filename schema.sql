@@ -1,10 +1,13 @@
 -- Create user table in SQLite
 -- maximum user name lenght 32
-CREATE TABLE users (
+CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT UNIQUE NOT NULL CHECK(length(username) <= 32),
     password_hash TEXT NOT NULL,
-    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    -- bumped with the user's user_device_usage rows, user page charts are
+    -- cached by it
+    usage_version INTEGER NOT NULL DEFAULT 0
 );
 
 -- index for users if UNIQUE somehow failed us
@@ -13,12 +16,13 @@ CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
 -- Create reservable device table
 -- maximum device name lenght 32
 -- maximum description size 4k
-CREATE TABLE devices (
+CREATE TABLE IF NOT EXISTS devices (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL CHECK(length(name) <= 32),
     description TEXT CHECK(length(description) <= 4096),
     created_by INTEGER,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 0,
     FOREIGN KEY (created_by) REFERENCES users(id)
 );
 
@@ -27,13 +31,14 @@ CREATE INDEX IF NOT EXISTS idx_devices_created_by ON devices(created_by);
 CREATE INDEX IF NOT EXISTS idx_devices_name ON devices(name);
 
 -- Create reservations table
-CREATE TABLE reservations (
+CREATE TABLE IF NOT EXISTS reservations (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
     device_id INTEGER NOT NULL,
     reserved_until INTEGER NOT NULL,
     created_at INTEGER DEFAULT (strftime('%s','now')),
     ended_at INTEGER DEFAULT NULL,
+    starts_at INTEGER DEFAULT (strftime('%s','now')),
     FOREIGN KEY (user_id) REFERENCES users(id),
     FOREIGN KEY (device_id) REFERENCES devices(id)
 );
@@ -41,12 +46,73 @@ CREATE TABLE reservations (
 -- Indexes for reservations
 CREATE INDEX IF NOT EXISTS idx_reservations_user_id ON reservations(user_id);
 CREATE INDEX IF NOT EXISTS idx_reservations_device_id ON reservations(device_id);
-CREATE INDEX IF NOT EXISTS idx_reservations_device_active ON reservations(device_id, reserved_until, ended_at);
-CREATE INDEX IF NOT EXISTS idx_reservations_user_active ON reservations(user_id, reserved_until, ended_at);
+-- live reservations only, ended history is never read through these
+CREATE INDEX IF NOT EXISTS idx_reservations_device_live ON reservations(device_id, reserved_until) WHERE ended_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_reservations_user_live ON reservations(user_id, reserved_until) WHERE ended_at IS NULL;
 CREATE INDEX IF NOT EXISTS idx_reservations_created_at ON reservations(created_at);
+CREATE INDEX IF NOT EXISTS idx_reservations_user_created_at ON reservations(user_id, created_at);
+-- live reservations by expiry time, sweeper.py finds expired ones through it
+CREATE INDEX IF NOT EXISTS idx_reservations_expiry ON reservations(reserved_until) WHERE ended_at IS NULL;
+-- live reservations by start time, next booking to start for API ETags
+CREATE INDEX IF NOT EXISTS idx_reservations_starts ON reservations(starts_at) WHERE ended_at IS NULL;
+
+-- Reserved time intervals [starts_at, ended_at or reserved_until) in an
+-- R*Tree for "which devices are free between T1 and T2" queries. Coordinates
+-- are 32-bit floats rounded outwards, exact check is done against reservations
+CREATE VIRTUAL TABLE IF NOT EXISTS reservation_intervals USING rtree(
+    id,
+    starts_at,
+    ends_at,
+    +device_id
+);
+
+-- starts_at has no default on databases that got it from migrate.py, an
+-- insert leaving it out starts when it was created like on a fresh database
+CREATE TRIGGER IF NOT EXISTS trg_reservations_starts_at AFTER INSERT ON reservations
+WHEN new.starts_at IS NULL
+BEGIN
+    UPDATE reservations
+    SET starts_at = COALESCE(new.created_at, strftime('%s','now'))
+    WHERE id = new.id;
+END;
+
+-- same start as trg_reservations_starts_at, whichever of them fires first
+CREATE TRIGGER IF NOT EXISTS trg_reservation_intervals_add AFTER INSERT ON reservations
+BEGIN
+    INSERT INTO reservation_intervals (id, starts_at, ends_at, device_id)
+    VALUES (new.id, COALESCE(new.starts_at, new.created_at, strftime('%s','now')),
+            MAX(COALESCE(new.starts_at, new.created_at, strftime('%s','now')),
+                COALESCE(new.ended_at, new.reserved_until)),
+            new.device_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_reservation_intervals_update
+AFTER UPDATE OF starts_at, reserved_until, ended_at ON reservations
+BEGIN
+    UPDATE reservation_intervals
+    SET starts_at = new.starts_at,
+        ends_at = MAX(new.starts_at, COALESCE(new.ended_at, new.reserved_until))
+    WHERE id = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_reservation_intervals_delete AFTER DELETE ON reservations
+BEGIN
+    DELETE FROM reservation_intervals WHERE id = old.id;
+END;
+
+-- Per user and device reservation rollup for user page statistics, updated
+-- in the same transaction as reservations are created and released.
+-- total_seconds sums MAX(COALESCE(ended_at, reserved_until) - starts_at, 0)
+CREATE TABLE IF NOT EXISTS user_device_usage (
+    user_id INTEGER NOT NULL,
+    device_id INTEGER NOT NULL,
+    reservation_count INTEGER NOT NULL DEFAULT 0,
+    total_seconds INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, device_id)
+) WITHOUT ROWID;
 
 -- Create comments table
-CREATE TABLE comments (
+CREATE TABLE IF NOT EXISTS comments (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     device_id INTEGER NOT NULL,
     user_id INTEGER NOT NULL,
@@ -59,4 +125,108 @@ CREATE TABLE comments (
 -- Indexes for comments
 CREATE INDEX IF NOT EXISTS idx_comments_device_id ON comments(device_id);
 CREATE INDEX IF NOT EXISTS idx_comments_user_id ON comments(user_id);
-CREATE INDEX IF NOT EXISTS idx_comments_device_created_at ON comments(device_id, created_at);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_comments_device_created_at ON comments(device_id, created_at);
+
+-- Row counters maintained by triggers, unfiltered device list total is read
+-- from here instead of running COUNT(*) over devices
+CREATE TABLE IF NOT EXISTS table_counts (
+    name TEXT PRIMARY KEY,
+    row_count INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO table_counts (name, row_count) VALUES ('devices', 0);
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_count_insert AFTER INSERT ON devices
+BEGIN
+    UPDATE table_counts SET row_count = row_count + 1 WHERE name = 'devices';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_count_delete AFTER DELETE ON devices
+BEGIN
+    UPDATE table_counts SET row_count = row_count - 1 WHERE name = 'devices';
+END;
+
+-- Change counters per table, bumped by triggers on every write. API uses
+-- them as ETag so unchanged data is answered 304 without querying it
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO table_versions (name) VALUES ('devices'), ('reservations'), ('comments');
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_version_insert AFTER INSERT ON devices
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'devices';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_version_update AFTER UPDATE ON devices
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'devices';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_version_delete AFTER DELETE ON devices
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'devices';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_reservations_version_insert AFTER INSERT ON reservations
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'reservations';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_reservations_version_update AFTER UPDATE ON reservations
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'reservations';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_reservations_version_delete AFTER DELETE ON reservations
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'reservations';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_comments_version_insert AFTER INSERT ON comments
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'comments';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_comments_version_update AFTER UPDATE ON comments
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'comments';
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_comments_version_delete AFTER DELETE ON comments
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'comments';
+END;
+
+-- Full-text index over device name and description, external content table
+-- kept in sync with devices by triggers. prefix indexes make 'word*' cheap
+CREATE VIRTUAL TABLE IF NOT EXISTS devices_fts USING fts5(
+    name,
+    description,
+    content='devices',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_fts_insert AFTER INSERT ON devices
+BEGIN
+    INSERT INTO devices_fts (rowid, name, description)
+    VALUES (new.id, new.name, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_fts_delete AFTER DELETE ON devices
+BEGIN
+    INSERT INTO devices_fts (devices_fts, rowid, name, description)
+    VALUES ('delete', old.id, old.name, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_devices_fts_update AFTER UPDATE OF name, description ON devices
+BEGIN
+    INSERT INTO devices_fts (devices_fts, rowid, name, description)
+    VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO devices_fts (rowid, name, description)
+    VALUES (new.id, new.name, new.description);
+END;
@@ -1,74 +1,245 @@
 #!/usr/bin/env python3
-'''stress test for slotkeeper'''
-import sqlite3
+'''stress test data generator for slotkeeper.
+
+Generates users, devices, comments and reservation history into an
+existing or new database. Rows are generated in worker processes chunk by
+chunk and streamed to the single writer, indexes and triggers of the
+loaded tables are dropped for the load and rebuilt once at the end,
+together with everything migrate.py derives from the data.
+
+    python seed.py database.db --users 100000 --devices 100000 --comments 100
+'''
+import argparse
 import hashlib
+import math
+import multiprocessing
+import os
+import random
+import sqlite3
 import time
+import config
+import migrate
 
 DB_PATH = 'database.db'
 N_USERS = 100000
 N_DEVICES = 100000
 COMMENTS_PER_DEVICE = 100
+RESERVATIONS_PER_DEVICE = 20
+LOADED_TABLES = ('users', 'devices', 'comments', 'reservations')
+
+# pragmas for the load only, data is not safe from crashes while they are on
+LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+    'locking_mode': 'EXCLUSIVE'
+}
+
+WORDS = ('probe board proto rev fixed flaky firmware flash boot serial uart jtag '
+         'power supply fan noisy stable lab rack shelf bench cable usb hdmi pcie '
+         'sensor camera display battery thermal test nightly regression build').split()
 
 def hash_password(password):
     '''pasword hash for passwords'''
     return hashlib.sha256(password.encode()).hexdigest()
 
-def insert_users(conn, n):
-    '''generic user insert'''
-    print('Inserting users...')
-    users = [(f'user{i}', hash_password(f'pass{i}')) for i in range(n)]
-    conn.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)', users)
-    conn.commit()
+def skewed(rng, n, skew):
+    '''random index below n, skew 0 is uniform and larger skew favours low indexes'''
+    return min(int(n * rng.random() ** (1 + skew)), n - 1)
 
-def insert_devices(conn, n):
-    '''generic device insert'''
-    print('Inserting devices...')
-    devices = [(f'device{i}', f'description of device {i}', i % N_USERS + 1) for i in range(n)]
-    conn.executemany('INSERT INTO devices (name, description, created_by) VALUES (?, ?, ?)',
-                     devices)
-    conn.commit()
+def weights(n, skew):
+    '''share of rows per index under skewed(), sums to 1'''
+    exponent = 1 / (1 + skew)
+    return [((i + 1) / n) ** exponent - (i / n) ** exponent for i in range(n)]
 
-def insert_comments(conn, n_devices, comments_per_device):
-    '''generic comment insert'''
-    print('Inserting comments...')
-    start_time = time.time()
-    batch = []
-    batch_size = 10_000
-
-    for d in range(n_devices):
-        device_id = d + 1
-        for c in range(comments_per_device):
-            user_id = (d + c) % N_USERS + 1
-            content = f'Comment {c} for device {device_id}'
-            batch.append((device_id, user_id, content))
-
-            if len(batch) >= batch_size:
-                conn.executemany(
-                    'INSERT INTO comments (device_id, user_id, content) VALUES (?, ?, ?)',
-                    batch
-                )
-                conn.commit()
-                print(f'Inserted {len(batch)} comments '
-                      f'(total so far: {d * comments_per_device + c + 1})')
-                batch = []
-
-    if batch:
-        conn.executemany(
-            'INSERT INTO comments (device_id, user_id, content) VALUES (?, ?, ?)',
-            batch
-        )
-        conn.commit()
-        print(f'Inserted final batch of {len(batch)} comments')
+def sentence(rng, n_words):
+    '''few random words'''
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+def user_rows(task):
+    '''users first..last'''
+    first, last, _ = task
+    return [(i, f'user{i}', hash_password(f'pass{i}')) for i in range(first, last)]
+
+def device_rows(task):
+    '''devices first..last created by skewed users'''
+    first, last, args = task
+    rng = random.Random(f'devices{first}')
+    rows = []
+    for i in range(first, last):
+        description = '\n'.join(sentence(rng, rng.randint(3, 12))
+                                for _ in range(rng.randint(1, 5)))
+        rows.append((i, f'device{i}', description,
+                     args['user_base'] + skewed(rng, args['users'], args['skew']) + 1))
+    return rows
+
+def comment_rows(task):
+    '''comments of devices first..last spread over the history'''
+    first, last, args = task
+    rng = random.Random(f'comments{first}')
+    now = args['now']
+    rows = []
+    for i in range(first, last):
+        count = round(args['comments_per_device'] * args['device_weights'][i - first])
+        for _ in range(count):
+            rows.append((args['device_base'] + i,
+                         args['user_base'] + skewed(rng, args['users'], args['skew']) + 1,
+                         sentence(rng, rng.randint(2, 30)),
+                         now - rng.randint(0, args['history'])))
+    return rows
+
+def reservation_rows(task):
+    '''non-overlapping reservation timeline of each device first..last.
+
+    Reservations of a device follow each other from the start of history
+    to a week ahead, so the latest ones are active or booked ahead. Most
+    are made shortly before they start and some are released early.
+    '''
+    first, last, args = task
+    rng = random.Random(f'reservations{first}')
+    now = args['now']
+    start = now - args['history']
+    span = args['history'] + 7 * 86400
+    rows = []
+    for i in range(first, last):
+        count = round(args['reservations_per_device'] * args['device_weights'][i - first])
+        if not count:
+            continue
+        slot = span / count
+        for n in range(count):
+            starts_at = int(start + n * slot + rng.uniform(0, slot * 0.3))
+            length = min(rng.lognormvariate(math.log(7200), 1.2), slot * 0.7)
+            reserved_until = starts_at + max(int(length), 900)
+            created_at = starts_at - int(rng.expovariate(1 / 3600) if rng.random() < 0.8
+                                         else rng.uniform(0, 3 * 86400))
+            ended_at = None
+            if reserved_until <= now:
+                ended_at = reserved_until
+                if rng.random() < 0.3:
+                    ended_at = starts_at + int((reserved_until - starts_at) * rng.random())
+            elif created_at > now:
+                created_at = now
+            rows.append((args['user_base'] + skewed(rng, args['users'], args['skew']) + 1,
+                         args['device_base'] + i, reserved_until, created_at,
+                         ended_at, starts_at))
+    return rows
+
+INSERTS = {
+    'users': 'INSERT INTO users (id, username, password_hash) VALUES (?, ?, ?)',
+    'devices': 'INSERT INTO devices (id, name, description, created_by) VALUES (?, ?, ?, ?)',
+    'comments': '''INSERT INTO comments (device_id, user_id, content, created_at)
+                   VALUES (?, ?, ?, ?)''',
+    'reservations': '''INSERT INTO reservations
+                           (user_id, device_id, reserved_until, created_at, ended_at, starts_at)
+                       VALUES (?, ?, ?, ?, ?, ?)'''
+}
 
+def chunks(first, last, size):
+    '''(start, stop) ranges covering first..last'''
+    for start in range(first, last, size):
+        yield start, min(start + size, last)
+
+def load(conn, pool, table, generate, tasks):
+    '''insert rows generated by pool workers, chunks come in order'''
+    print(f'Inserting {table}...')
+    start_time = time.time()
+    total = 0
+    for rows in pool.imap(generate, tasks):
+        conn.executemany(INSERTS[table], rows)
+        total += len(rows)
+    conn.commit()
     elapsed = time.time() - start_time
-    print(f'Inserted all comments in {elapsed:.2f} seconds')
+    print(f'Inserted {total} {table} in {elapsed:.2f} seconds')
+
+def drop_indexes_and_triggers(conn):
+    '''drop indexes and triggers of loaded tables, returns sql to recreate them'''
+    placeholders = ', '.join('?' * len(LOADED_TABLES))
+    rows = conn.execute(
+        f'''SELECT type, name, sql FROM sqlite_master
+            WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+            AND tbl_name IN ({placeholders})''', LOADED_TABLES).fetchall()
+    for kind, name, _ in rows:
+        conn.execute(f'DROP {kind.upper()} {name}')
+    conn.commit()
+    return [sql for _, _, sql in rows]
+
+def set_pragmas(conn, pragmas):
+    '''apply pragmas to connection'''
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}')
 
 def main():
     '''main'''
-    conn = sqlite3.connect(DB_PATH)
-    insert_users(conn, N_USERS)
-    insert_devices(conn, N_DEVICES)
-    insert_comments(conn, N_DEVICES, COMMENTS_PER_DEVICE)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('db_path', nargs='?', default=DB_PATH)
+    parser.add_argument('--users', type=int, default=N_USERS)
+    parser.add_argument('--devices', type=int, default=N_DEVICES)
+    parser.add_argument('--comments', type=int, default=COMMENTS_PER_DEVICE,
+                        help='average comments per device')
+    parser.add_argument('--reservations', type=int, default=RESERVATIONS_PER_DEVICE,
+                        help='average reservations per device')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='0 spreads activity evenly, larger values focus it on few '
+                             'users and devices')
+    parser.add_argument('--history-days', type=int, default=365)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=10_000,
+                        help='rows generated per worker task')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db_path)
+    migrate.apply_schema(conn)
+    set_pragmas(conn, LOAD_PRAGMAS)
+    recreate = drop_indexes_and_triggers(conn)
+
+    user_base = conn.execute('SELECT COALESCE(MAX(id), 0) FROM users').fetchone()[0]
+    device_base = conn.execute('SELECT COALESCE(MAX(id), 0) FROM devices').fetchone()[0]
+    shared = {
+        'users': args.users,
+        'skew': args.skew,
+        'user_base': user_base,
+        'device_base': device_base,
+        'now': int(time.time()),
+        'history': args.history_days * 86400
+    }
+    device_weights = [w * args.devices for w in weights(args.devices, args.skew)]
+
+    def per_device(per_device_avg, key):
+        # device chunks sized to about chunk_size rows each
+        size = max(1, args.chunk_size // max(per_device_avg, 1))
+        return [(first, last, dict(shared, **{key: per_device_avg},
+                                   device_weights=device_weights[first - 1:last - 1]))
+                for first, last in chunks(1, args.devices + 1, size)]
+
+    with multiprocessing.Pool(args.workers) as pool:
+        load(conn, pool, 'users', user_rows,
+             [(first, last, None) for first, last in
+              chunks(user_base + 1, user_base + args.users + 1, args.chunk_size)])
+        load(conn, pool, 'devices', device_rows,
+             [(first, last, shared) for first, last in
+              chunks(device_base + 1, device_base + args.devices + 1, args.chunk_size)])
+        if args.comments:
+            load(conn, pool, 'comments', comment_rows,
+                 per_device(args.comments, 'comments_per_device'))
+        if args.reservations:
+            load(conn, pool, 'reservations', reservation_rows,
+                 per_device(args.reservations, 'reservations_per_device'))
+
+    print('Rebuilding indexes and triggers...')
+    start_time = time.time()
+    for sql in recreate:
+        conn.execute(sql)
+    conn.commit()
+    # derived tables were not maintained during the load, rebuild them all
+    migrate.migrate(conn, rebuild=[name for name, _ in migrate.MIGRATIONS])
+    conn.execute('UPDATE table_versions SET version = version + 1')
+    conn.execute('ANALYZE')
+    conn.commit()
+    print(f'Rebuilt in {time.time() - start_time:.2f} seconds')
+
+    set_pragmas(conn, {'locking_mode': 'NORMAL',
+                       'journal_mode': config.DB_PRAGMAS['journal_mode']})
     conn.close()
 
 if __name__ == '__main__':
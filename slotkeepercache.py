@@ -0,0 +1,170 @@
+'''in-process caches for slotkeeper'''
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    '''Small thread safe cache where entries expire after ttl seconds'''
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, default=None):
+        '''cached value or default if missing or expired'''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                self._misses += 1
+                return default
+            self._hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        '''store value, oldest entry is dropped when cache is full'''
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.max_entries:
+                self._data = {k: v for k, v in self._data.items() if v[0] > now}
+                if len(self._data) >= self.max_entries:
+                    del self._data[next(iter(self._data))]
+            self._data[key] = (now + self.ttl, value)
+
+    def clear(self):
+        '''drop all entries'''
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        '''hit and miss counters'''
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._data)
+            }
+
+class LRUCache:
+    '''Thread safe cache holding max_entries most recently used entries'''
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, default=None):
+        '''cached value or default, hit marks entry most recently used'''
+        with self._lock:
+            if key not in self._data:
+                self._misses += 1
+                return default
+            self._hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        '''store value, least recently used entry is dropped when cache is full'''
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        '''drop single entry'''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        '''drop all entries'''
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        '''hit and miss counters'''
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._data)
+            }
+
+class FragmentCache:
+    '''Thread safe LRU cache of rendered fragments, capped by total size.
+
+    Entries are stored with a version, get with any other version is a
+    miss, so a changed source never serves its old rendering. Value is a
+    string or tuple of strings, size is counted in characters.
+    '''
+    def __init__(self, max_chars=4_000_000):
+        self.max_chars = max_chars
+        self._data = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def _size(value):
+        return len(value) if isinstance(value, str) else sum(len(part) for part in value)
+
+    def __drop(self, key):
+        _, _, size = self._data.pop(key)
+        self._chars -= size
+
+    def get(self, key, version, default=None):
+        '''cached value of this version or default'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] != version:
+                self._misses += 1
+                return default
+            self._hits += 1
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, version, value):
+        '''store value, least recently used entries go until it fits'''
+        size = self._size(value)
+        with self._lock:
+            if key in self._data:
+                self.__drop(key)
+            if size > self.max_chars:
+                return
+            while self._chars + size > self.max_chars:
+                self.__drop(next(iter(self._data)))
+                self._evictions += 1
+            self._data[key] = (version, value, size)
+            self._chars += size
+
+    def pop(self, key):
+        '''drop single entry'''
+        with self._lock:
+            if key in self._data:
+                self.__drop(key)
+
+    def clear(self):
+        '''drop all entries'''
+        with self._lock:
+            self._data.clear()
+            self._chars = 0
+
+    def stats(self):
+        '''hit, miss and eviction counters, hit rate and size'''
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else 0.0,
+                'evictions': self._evictions,
+                'size': len(self._data),
+                'chars': self._chars,
+                'max_chars': self.max_chars
+            }
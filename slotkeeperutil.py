@@ -1,7 +1,22 @@
 '''util module for slotkeeper'''
+import base64
+import binascii
+from datetime import datetime
 import math
+import time
 import uuid
 
+# range of SQLite INTEGER, larger values from a crafted cursor can not be bound
+SQLITE_INTEGER_MIN = -2**63
+SQLITE_INTEGER_MAX = 2**63 - 1
+
+# larger page numbers would make an OFFSET too big to bind
+MAX_PAGE = 2**31
+
+def is_sqlite_integer(value):
+    '''value fits in SQLite INTEGER'''
+    return SQLITE_INTEGER_MIN <= value <= SQLITE_INTEGER_MAX
+
 def format_duration_to_string(seconds):
     '''convert seconds to ui string'''
     if not isinstance(seconds, (int, float)) or seconds < 0:
@@ -39,30 +54,168 @@ def generate_csrf_token(session):
     session['csrf_token'] = token
     return token
 
-def fill_in_device_list(session, db, devices):
-    '''build device list for ui'''
+def encode_cursor(direction, device_id):
+    '''opaque page cursor, direction is 'a' (after id) or 'b' (before id)'''
+    raw = f'{direction}{device_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token):
+    '''page cursor to (after_id, before_id), (None, None) if missing or broken'''
+    if not token:
+        return None, None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        device_id = int(raw[1:])
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None, None
+    if not is_sqlite_integer(device_id):
+        return None, None
+
+    if raw[0] == 'a':
+        return device_id, None
+    if raw[0] == 'b':
+        return None, device_id
+    return None, None
+
+def page_cursors(devices):
+    '''next and previous page cursors for search_devices result'''
+    next_cursor = None
+    prev_cursor = None
+    if devices['next_after_id'] is not None:
+        next_cursor = encode_cursor('a', devices['next_after_id'])
+    if devices['prev_before_id'] is not None:
+        prev_cursor = encode_cursor('b', devices['prev_before_id'])
+    return next_cursor, prev_cursor
+
+def parse_datetime_local(value):
+    '''datetime-local input value to timestamp, None if empty or broken'''
+    try:
+        return int(datetime.strptime(value, '%Y-%m-%dT%H:%M').timestamp())
+    except (TypeError, ValueError):
+        return None
+
+def encode_comment_cursor(before):
+    '''opaque cursor of comment page position (created_at, id)'''
+    raw = f'{before[0]}.{before[1]}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_comment_cursor(token):
+    '''comment cursor to (created_at, id), None if missing or broken'''
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        created_at, comment_id = raw.split('.')
+        before = int(created_at), int(comment_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if not all(is_sqlite_integer(value) for value in before):
+        return None
+    return before
+
+def get_free_between(list_args):
+    '''(starts_at, ends_at) of list free time filter, None when not set.
+    Missing start is now and missing end is the start moment itself'''
+    starts_at = parse_datetime_local(list_args['free_from'])
+    ends_at = parse_datetime_local(list_args['free_until'])
+    if starts_at is None and ends_at is None:
+        return None
+    if starts_at is None:
+        starts_at = int(time.time())
+    if ends_at is None or ends_at < starts_at:
+        ends_at = starts_at
+    return starts_at, ends_at
+
+def get_list_args(args):
+    '''device list state (query, only mine, page, cursor and free time) from request args'''
+    try:
+        page = int(args.get('page', 1))
+    except ValueError:
+        page = 1
+    if page > MAX_PAGE:
+        page = 1
+
+    return {
+        'q': args.get('q', ''),
+        'only_mine': args.get('only_mine') == '1',
+        'page': max(page, 1),
+        'cursor': args.get('cursor') or None,
+        'free_from': args.get('free_from') or None,
+        'free_until': args.get('free_until') or None
+    }
+
+def url_list_args(list_args):
+    '''url_for arguments to link back to the same list page'''
+    return {
+        'page': list_args['page'],
+        'q': list_args['q'],
+        'only_mine': '1' if list_args['only_mine'] else None,
+        'cursor': list_args['cursor'],
+        'free_from': list_args['free_from'],
+        'free_until': list_args['free_until']
+    }
+
+def get_original_list_args(form):
+    '''url_for arguments to get back to list page posted from form'''
+    return {
+        'page': form.get('original_page', 1, type=int),
+        'q': form.get('original_query', ''),
+        'only_mine': '1' if form.get('original_only_mine', '') == '1' else None,
+        'cursor': form.get('original_cursor') or None,
+        'free_from': form.get('original_free_from') or None,
+        'free_until': form.get('original_free_until') or None
+    }
+
+def device_reservation(device):
+    '''active reservation of search_devices row, None when device is free'''
+    if device.get('reservation_id') is None:
+        return None
+    return {
+        'id': device['reservation_id'],
+        'user_id': device['reservation_user_id'],
+        'reserved_until': device['reservation_reserved_until'],
+        'username': device['reservation_username']
+    }
+
+def device_upcoming(device):
+    '''booking of the user that has not started yet, from search_devices row'''
+    if device.get('upcoming_id') is None:
+        return None
+    return {
+        'id': device['upcoming_id'],
+        'starts_at': device['upcoming_starts_at'],
+        'reserved_until': device['upcoming_reserved_until']
+    }
+
+def description_preview(description):
+    '''cut excessive long description to preview'''
+    desc = description or ''
+    lines = desc.splitlines()
+    preview = '\n'.join(lines[:3])[:250]
+    if len(desc) > 250 or desc.count('\n') >= 3:
+        preview += '\n...'
+    return preview
+
+def fill_in_device_list(user_id, devices, card_parts):
+    '''build device list for ui from search_devices rows,
+    card_parts(device) gives the (head, preview) markup of device card'''
     device_data = []
-    user = db.get_user_by_username(session['username'])
 
-    if not user:
+    if not user_id:
         return device_data
 
     for device in devices:
-        reservation = db.get_active_reservation_for_device(device['id'])
-        owned = reservation and reservation['user_id'] == user['id'] if reservation else False
-        desc = device['description'] or ''
-
-        # cut excessive long description to preview
-        lines = desc.splitlines()
-        preview = '\n'.join(lines[:3])[:250]
-        if len(desc) > 250 or desc.count('\n') >= 3:
-            preview += '\n...'
+        reservation = device_reservation(device)
+        owned = reservation['user_id'] == user_id if reservation else False
+        head, preview = card_parts(device)
 
         device_data.append(
             {
                 'device': device,
                 'reservation': reservation,
                 'user_owned': owned,
+                'upcoming': device_upcoming(device),
+                'head': head,
                 'preview': preview
             }
         )
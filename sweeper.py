@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+'''end expired slotkeeper reservations by stamping their ended_at'''
+import argparse
+import threading
+import time
+import config
+from database import Database
+
+DB_PATH = 'database.db'
+
+def sweep(db, batch_size=500, pause=0.01):
+    '''end all expired reservations batch by batch, returns how many were ended.
+    Write lock is released between batches so requests can get in'''
+    total = 0
+    while True:
+        ended = db.end_expired_reservations(batch_size)
+        total += ended
+        if ended < batch_size:
+            return total
+        time.sleep(pause)
+
+def run(db, interval, batch_size, stop=None):
+    '''sweep every interval seconds until stop event is set'''
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        sweep(db, batch_size)
+        stop.wait(interval)
+
+def start_sweeper(db, interval, batch_size):
+    '''run sweeper in daemon thread of this process, returns its stop event'''
+    stop = threading.Event()
+    thread = threading.Thread(target=run, args=(db, interval, batch_size, stop),
+                              name='reservation-sweeper', daemon=True)
+    thread.start()
+    return stop
+
+def main():
+    '''main'''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db_path', nargs='?', default=DB_PATH)
+    parser.add_argument('--interval', type=float, default=config.SWEEPER_INTERVAL or 60.0,
+                        help='seconds between sweeps')
+    parser.add_argument('--batch-size', type=int, default=config.SWEEPER_BATCH_SIZE,
+                        help='reservations ended per write transaction')
+    parser.add_argument('--once', action='store_true', help='sweep once and exit')
+    args = parser.parse_args()
+
+    db = Database(args.db_path, pool_size=1, pragmas=config.DB_PRAGMAS,
+                  write_retries=config.DB_WRITE_RETRIES,
+                  write_backoff=config.DB_WRITE_BACKOFF)
+    try:
+        if args.once:
+            print(f'Ended {sweep(db, args.batch_size)} expired reservations.')
+        else:
+            run(db, args.interval, args.batch_size)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()